@@ -10,12 +10,31 @@ import platform
 import socket
 import tempfile
 import os
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
 from functools import wraps
-from datetime import datetime
+from datetime import datetime, date
 from flask import Flask, request, jsonify
 from flask_cors import CORS
+import requests
 from kafka import KafkaProducer
 from clickhouse_driver import Client
+from clickhouse_driver import errors as ch_errors
+# 与 backend/template_utils.py 为同一份代码（Agent 独立部署，故随 Agent 保留一份），保证渲染语义与主程序一致
+from template_utils import (
+    iter_kafka_messages, iter_kafka_payloads, kafka_template_is_object, iter_clickhouse_sqls,
+    parse_columnar_template, iter_clickhouse_rows,
+)
+
+try:
+    import numpy as np
+    import pandas  # noqa: F401  clickhouse-driver 的 use_numpy 同时依赖 pandas
+except ImportError:  # 可选依赖：列式写入的 use_numpy 需要 numpy 与 pandas（pip install clickhouse-driver[numpy]）
+    np = None
 
 app = Flask(__name__)
 CORS(app)
@@ -29,6 +48,46 @@ def generate_machine_token():
 
 AGENT_TOKEN = generate_machine_token()
 
+# 本 Agent 支持的能力，通过 health 接口告知主程序（主程序据此决定下发格式，兼容旧版 Agent）
+# raw_payload: Kafka 消息可为主程序预序列化好的 JSON 文本，直接编码为 bytes 发送
+# columnar_insert: ClickHouse 按列下发数据，整批一次 INSERT ... VALUES（columnar=True）
+# render: 主程序只下发模板与参数配置，由 Agent 本地渲染
+# jobs: 异步任务接口 /api/agent/jobs（提交后轮询或回调）
+AGENT_FEATURES = ['raw_payload', 'columnar_insert', 'render', 'jobs']
+
+# Kafka Producer 池：按 bootstrap + 安全配置哈希复用长连接，避免每次执行都重新建连/握手/拉元数据
+# {key: {'key', 'producer', 'temp_cafile', 'in_use', 'last_used', 'broken'}}
+KAFKA_POOL_MAX_SIZE = int(os.environ.get('AGENT_KAFKA_POOL_MAX_SIZE', '16'))
+KAFKA_POOL_IDLE_SECONDS = int(os.environ.get('AGENT_KAFKA_POOL_IDLE_SECONDS', '300'))
+_kafka_producers = {}
+_kafka_pool_lock = threading.Lock()
+
+# ClickHouse 原生连接池：按 host/port/database/user（及密码哈希）复用已建好的连接，Client 非线程安全，借出期间独占
+# {key: [{'client', 'last_used'}, ...]}，只保存空闲连接；总空闲数不超过 CLICKHOUSE_POOL_MAX_SIZE
+# 每个 key 已打开（借出 + 空闲）的连接数不超过 CLICKHOUSE_MAX_OPEN_PER_KEY，达到上限时等待归还，超时报错
+CLICKHOUSE_POOL_MAX_SIZE = int(os.environ.get('AGENT_CLICKHOUSE_POOL_MAX_SIZE', '16'))
+CLICKHOUSE_POOL_IDLE_SECONDS = int(os.environ.get('AGENT_CLICKHOUSE_POOL_IDLE_SECONDS', '300'))
+CLICKHOUSE_MAX_OPEN_PER_KEY = int(os.environ.get('AGENT_CLICKHOUSE_MAX_OPEN_PER_KEY', '16'))
+CLICKHOUSE_POOL_WAIT_SECONDS = float(os.environ.get('AGENT_CLICKHOUSE_POOL_WAIT_SECONDS', '30'))
+_clickhouse_idle = {}
+_clickhouse_open = {}  # key -> 已打开的连接数（含借出中的）
+_clickhouse_pool_lock = threading.Condition(threading.Lock())
+_clickhouse_pool_stats = {'hits': 0, 'misses': 0, 'reconnects': 0, 'waits': 0, 'wait_timeouts': 0}
+
+_pool_reaper_thread = None
+_pool_reaper_lock = threading.Lock()
+
+# 异步任务：固定大小的工作线程池 + 有界排队（运行中与排队总数超过上限时拒绝提交）
+# {job_id: {'job_id', 'status', 'task_type', 'batch_no', 'submitted_at', 'started_at', 'finished_at', 'result', 'error', ...}}
+AGENT_JOB_WORKERS = int(os.environ.get('AGENT_JOB_WORKERS', '4'))
+AGENT_JOB_QUEUE_SIZE = int(os.environ.get('AGENT_JOB_QUEUE_SIZE', '64'))
+AGENT_JOB_TTL_SECONDS = int(os.environ.get('AGENT_JOB_TTL_SECONDS', '3600'))
+_jobs = {}
+_jobs_lock = threading.Lock()
+_job_executor = ThreadPoolExecutor(max_workers=AGENT_JOB_WORKERS, thread_name_prefix='agent-job')
+_job_slots = threading.BoundedSemaphore(AGENT_JOB_WORKERS + AGENT_JOB_QUEUE_SIZE)
+
+
 # Kafka 证书缓存目录（下发任务时写入，按内容哈希去重，已有则校验后复用）
 def _cert_cache_dir():
     base = os.environ.get('AGENT_CERT_CACHE_DIR')
@@ -85,7 +144,18 @@ def require_token(f):
 @app.route('/api/agent/health', methods=['GET'])
 @require_token
 def health():
-    return jsonify({'success': True, 'status': 'ok'})
+    return jsonify({'success': True, 'status': 'ok', 'features': AGENT_FEATURES})
+
+
+def run_task(task_type, task_data, batch_no):
+    """执行一次下发的任务（同步接口与异步任务共用）；未知类型抛 ValueError"""
+    if task_data.get('render'):
+        task_data = expand_render_spec(task_type, task_data)
+    if task_type == 'kafka':
+        return execute_kafka(task_data, batch_no)
+    if task_type == 'clickhouse':
+        return execute_clickhouse(task_data, batch_no)
+    raise ValueError(f'Unknown task_type: {task_type}')
 
 
 @app.route('/api/agent/execute', methods=['POST'])
@@ -99,20 +169,21 @@ def execute():
 
         if not task_type or not task_data:
             return jsonify({'success': False, 'error': 'Missing task_type or task_data'}), 400
-
-        if task_type == 'kafka':
-            result = execute_kafka(task_data, batch_no)
-        elif task_type == 'clickhouse':
-            result = execute_clickhouse(task_data, batch_no)
-        else:
+        if task_type not in ('kafka', 'clickhouse'):
             return jsonify({'success': False, 'error': f'Unknown task_type: {task_type}'}), 400
 
-        return jsonify({
+        result = run_task(task_type, task_data, batch_no)
+
+        resp = {
             'success': True,
             'result': result,
             'batch_no': batch_no,
             'executed_at': datetime.now().isoformat()
-        })
+        }
+        # 大批量由主程序分块下发，每块独立执行并回显块序号
+        if task_data.get('chunk_no') is not None:
+            resp['chunk_no'] = task_data['chunk_no']
+        return jsonify(resp)
     except Exception as e:
         tb = traceback.format_exc()
         return jsonify({
@@ -122,18 +193,158 @@ def execute():
         }), 500
 
 
-def execute_kafka(task_data, batch_no):
-    bootstrap_servers = task_data.get('bootstrap_servers', 'localhost:9092')
-    topic = task_data.get('topic')
-    messages = task_data.get('messages', [])
-    config = task_data.get('config', {})
+def _job_view(job):
+    """对外返回的任务状态（不含下发数据）"""
+    return {k: job.get(k) for k in (
+        'job_id', 'status', 'task_type', 'batch_no', 'submitted_at', 'started_at', 'finished_at',
+        'result', 'error', 'traceback', 'callback_error'
+    )}
 
-    if not topic or not messages:
-        raise ValueError('Missing topic or messages')
 
+def _prune_jobs_locked(now):
+    """在持有 _jobs_lock 时调用：清理结束超过 AGENT_JOB_TTL_SECONDS 的任务记录"""
+    for job_id, job in list(_jobs.items()):
+        if job.get('finished_ts') and now - job['finished_ts'] > AGENT_JOB_TTL_SECONDS:
+            _jobs.pop(job_id, None)
+
+
+def _notify_job_callback(job):
+    try:
+        resp = requests.post(
+            job['callback_url'],
+            headers={'X-Agent-Token': AGENT_TOKEN},
+            json=_job_view(job),
+            timeout=10
+        )
+        if resp.status_code >= 400:
+            job['callback_error'] = f'{resp.status_code} {resp.text[:200]}'
+    except Exception as e:
+        job['callback_error'] = str(e)
+
+
+def _run_job(job_id, task_type, task_data, batch_no):
+    with _jobs_lock:
+        job = _jobs[job_id]
+        job['status'] = 'running'
+        job['started_at'] = datetime.now().isoformat()
+    try:
+        result = run_task(task_type, task_data, batch_no)
+        with _jobs_lock:
+            job['result'] = result
+            job['status'] = 'succeeded'
+    except Exception as e:
+        with _jobs_lock:
+            job['error'] = str(e)
+            job['traceback'] = traceback.format_exc()
+            job['status'] = 'failed'
+    finally:
+        with _jobs_lock:
+            job['finished_at'] = datetime.now().isoformat()
+            job['finished_ts'] = time.time()
+        _job_slots.release()
+    if job.get('callback_url'):
+        _notify_job_callback(job)
+
+
+@app.route('/api/agent/jobs', methods=['POST'])
+@require_token
+def submit_job():
+    """
+    异步提交任务：立即返回 job_id，任务在 Agent 端工作线程池中执行。
+    请求体同 /api/agent/execute，可选 callback_url（完成后 POST 任务状态，带 X-Agent-Token 头）。
+    排队已满时返回 503。
+    """
+    data = request.get_json() or {}
+    task_type = data.get('task_type')
+    task_data = data.get('task_data')
+    batch_no = data.get('batch_no', 1)
+    if not task_type or not task_data:
+        return jsonify({'success': False, 'error': 'Missing task_type or task_data'}), 400
+    if task_type not in ('kafka', 'clickhouse'):
+        return jsonify({'success': False, 'error': f'Unknown task_type: {task_type}'}), 400
+    if not _job_slots.acquire(blocking=False):
+        return jsonify({'success': False, 'error': 'Job queue is full'}), 503
+    job_id = uuid.uuid4().hex
+    with _jobs_lock:
+        _prune_jobs_locked(time.time())
+        _jobs[job_id] = {
+            'job_id': job_id,
+            'status': 'queued',
+            'task_type': task_type,
+            'batch_no': batch_no,
+            'submitted_at': datetime.now().isoformat(),
+            'callback_url': data.get('callback_url'),
+        }
+    try:
+        _job_executor.submit(_run_job, job_id, task_type, task_data, batch_no)
+    except Exception as e:
+        _job_slots.release()
+        with _jobs_lock:
+            _jobs.pop(job_id, None)
+        return jsonify({'success': False, 'error': str(e)}), 500
+    return jsonify({'success': True, 'job_id': job_id, 'status': 'queued'}), 202
+
+
+@app.route('/api/agent/jobs/<job_id>', methods=['GET'])
+@require_token
+def get_job(job_id):
+    """查询异步任务状态：queued / running / succeeded / failed"""
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        view = _job_view(job) if job else None
+    if view is None:
+        return jsonify({'success': False, 'error': 'Job not found'}), 404
+    return jsonify({'success': True, 'job': view})
+
+
+def expand_render_spec(task_type, task_data):
+    """
+    Agent 端渲染：task_data.render 为 {template, param_config, batch_no, start, count, reference_time}，
+    按与主程序相同的语义在本地生成 messages / sqls / 列式 data，替代主程序下发的展开结果。
+    Kafka 消息与 SQL 为惰性生成器，边渲染边发送/执行。
+    """
+    spec = task_data['render']
+    template = spec.get('template')
+    param_config = spec.get('param_config') or []
+    batch_no = int(spec.get('batch_no') or 1)
+    start = int(spec.get('start') or 0)
+    stop = start + int(spec.get('count') or 0)
+    reference_time = datetime.fromisoformat(spec['reference_time']) if spec.get('reference_time') else None
+    if reference_time is not None and reference_time.tzinfo is not None:
+        # 主程序下发带时区的时间：换算为本机本地时间（不带时区），时间戳与主程序一致，current_time 按本机时区格式化
+        reference_time = reference_time.astimezone().replace(tzinfo=None)
+    if not template or stop <= start:
+        raise ValueError('Missing render template or count')
+    expanded = {k: v for k, v in task_data.items() if k != 'render'}
+    if task_type == 'kafka':
+        if kafka_template_is_object(template, param_config, batch_no, reference_time):
+            expanded['messages'] = iter_kafka_payloads(template, param_config, batch_no, start, stop, reference_time)
+        else:
+            expanded['messages'] = iter_kafka_messages(template, param_config, batch_no, start, stop, reference_time)
+    elif task_data.get('insert'):
+        _, columns = parse_columnar_template(template)
+        rows = iter_clickhouse_rows(columns, param_config, batch_no, start, stop, reference_time)
+        expanded['data'] = [list(col) for col in zip(*rows)]
+    else:
+        template_sqls = json.loads(template) if isinstance(template, str) and template.startswith('[') else template
+        expanded['sqls'] = iter_clickhouse_sqls(template_sqls, param_config, batch_no, start, stop, reference_time)
+    return expanded
+
+
+def _serialize_kafka_value(v):
+    """bytes（预序列化消息）原样发送，dict 序列化为 JSON，其余转字符串"""
+    if isinstance(v, bytes):
+        return v
+    if isinstance(v, dict):
+        return json.dumps(v).encode('utf-8')
+    return str(v).encode('utf-8')
+
+
+def _build_producer_config(bootstrap_servers, config):
+    """根据连接配置生成 KafkaProducer 参数；返回 (producer_config, 需在 Producer 关闭后删除的临时证书路径)"""
     producer_config = {
         'bootstrap_servers': bootstrap_servers.split(','),
-        'value_serializer': lambda v: json.dumps(v).encode('utf-8') if isinstance(v, dict) else str(v).encode('utf-8')
+        'value_serializer': _serialize_kafka_value
     }
     security_protocol = (config.get('security_protocol') or 'PLAINTEXT').upper()
     producer_config['security_protocol'] = security_protocol
@@ -143,29 +354,155 @@ def execute_kafka(task_data, batch_no):
         producer_config['sasl_plain_username'] = config['username']
         producer_config['sasl_plain_password'] = config['password']
 
-    ssl_cafile_path = None
+    temp_cafile = None
     if security_protocol in ('SSL', 'SASL_SSL') and config.get('ssl_cafile'):
         ssl_cafile = config['ssl_cafile']
         if isinstance(ssl_cafile, str) and '-----BEGIN' in ssl_cafile:
             ssl_cafile_path = get_cached_cert_path(ssl_cafile)
-            if ssl_cafile_path:
-                producer_config['ssl_cafile'] = ssl_cafile_path
-            else:
+            if not ssl_cafile_path:
                 fd, ssl_cafile_path = tempfile.mkstemp(suffix='.pem')
                 try:
                     os.write(fd, ssl_cafile.encode('utf-8'))
                 finally:
                     os.close(fd)
-                producer_config['ssl_cafile'] = ssl_cafile_path
+                temp_cafile = ssl_cafile_path
+            producer_config['ssl_cafile'] = ssl_cafile_path
         else:
             producer_config['ssl_cafile'] = ssl_cafile
         producer_config['ssl_check_hostname'] = False
+    return producer_config, temp_cafile
+
+
+def _kafka_pool_key(bootstrap_servers, config):
+    """Producer 池的 key：bootstrap 与安全配置的哈希（密码、证书内容只参与哈希，不明文保存）"""
+    security_protocol = (config.get('security_protocol') or 'PLAINTEXT').upper()
+    ident = {
+        'bootstrap_servers': bootstrap_servers,
+        'security_protocol': security_protocol,
+    }
+    if security_protocol in ('SASL_PLAINTEXT', 'SASL_SSL'):
+        ident['sasl_mechanism'] = config.get('sasl_mechanism') or 'PLAIN'
+        ident['username'] = config.get('username')
+        ident['password'] = config.get('password')
+    if security_protocol in ('SSL', 'SASL_SSL'):
+        ident['ssl_cafile'] = config.get('ssl_cafile')
+    return hashlib.sha256(json.dumps(ident, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def _close_kafka_entry(entry):
+    try:
+        entry['producer'].close(timeout=5)
+    except Exception:
+        pass
+    temp_cafile = entry.get('temp_cafile')
+    if temp_cafile and os.path.isfile(temp_cafile):
+        try:
+            os.remove(temp_cafile)
+        except Exception:
+            pass
+
 
+def _evict_kafka_producers_locked(now):
+    """在持有 _kafka_pool_lock 时调用：摘除空闲超时的 Producer，超出上限时按最久未用淘汰；返回待关闭的条目"""
+    evicted = []
+    for key, entry in list(_kafka_producers.items()):
+        if entry['in_use'] == 0 and now - entry['last_used'] > KAFKA_POOL_IDLE_SECONDS:
+            evicted.append(_kafka_producers.pop(key))
+    idle = sorted((e['last_used'], k) for k, e in _kafka_producers.items() if e['in_use'] == 0)
+    while len(_kafka_producers) > KAFKA_POOL_MAX_SIZE and idle:
+        _, key = idle.pop(0)
+        evicted.append(_kafka_producers.pop(key))
+    return evicted
+
+
+def _pool_reaper():
+    """后台线程：定期关闭空闲超时的 Kafka Producer 与 ClickHouse 连接"""
+    while True:
+        time.sleep(max(min(KAFKA_POOL_IDLE_SECONDS, CLICKHOUSE_POOL_IDLE_SECONDS) / 2, 1))
+        with _kafka_pool_lock:
+            evicted = _evict_kafka_producers_locked(time.time())
+        for entry in evicted:
+            _close_kafka_entry(entry)
+        with _clickhouse_pool_lock:
+            stale = _evict_clickhouse_clients_locked(time.time())
+        for item in stale:
+            _disconnect_clickhouse(item['client'])
+
+
+def _ensure_pool_reaper():
+    global _pool_reaper_thread
+    with _pool_reaper_lock:
+        if _pool_reaper_thread is None or not _pool_reaper_thread.is_alive():
+            _pool_reaper_thread = threading.Thread(target=_pool_reaper, daemon=True)
+            _pool_reaper_thread.start()
+
+
+def acquire_kafka_producer(bootstrap_servers, config):
+    """从池中取（或新建）长连接 Producer；返回 (池条目, 是否复用)。用完须调用 release_kafka_producer"""
+    _ensure_pool_reaper()
+    key = _kafka_pool_key(bootstrap_servers, config)
+    with _kafka_pool_lock:
+        entry = _kafka_producers.get(key)
+        if entry is not None:
+            entry['in_use'] += 1
+            entry['last_used'] = time.time()
+            return entry, True
+    producer_config, temp_cafile = _build_producer_config(bootstrap_servers, config)
     try:
         producer = KafkaProducer(**producer_config)
     except Exception as e:
+        if temp_cafile and os.path.isfile(temp_cafile):
+            try:
+                os.remove(temp_cafile)
+            except Exception:
+                pass
         raise RuntimeError(f'Kafka 连接失败: {e}') from e
+    entry = {'key': key, 'producer': producer, 'temp_cafile': temp_cafile, 'in_use': 1, 'last_used': time.time(), 'broken': False}
+    with _kafka_pool_lock:
+        existing = _kafka_producers.get(key)
+        if existing is not None:
+            # 并发请求已先建好同一配置的 Producer，复用它并关闭本次新建的
+            existing['in_use'] += 1
+            existing['last_used'] = time.time()
+            duplicate, entry = entry, existing
+        else:
+            duplicate = None
+            _kafka_producers[key] = entry
+        evicted = _evict_kafka_producers_locked(time.time())
+    if duplicate is not None:
+        _close_kafka_entry(duplicate)
+    for e in evicted:
+        _close_kafka_entry(e)
+    return entry, duplicate is not None
+
+
+def release_kafka_producer(entry, healthy=True):
+    """归还 Producer；出错时（healthy=False）立即从池中摘除，最后一个使用者归还时关闭"""
+    with _kafka_pool_lock:
+        entry['in_use'] -= 1
+        entry['last_used'] = time.time()
+        if not healthy:
+            entry['broken'] = True
+            if _kafka_producers.get(entry['key']) is entry:
+                _kafka_producers.pop(entry['key'], None)
+        close_now = entry['broken'] and entry['in_use'] == 0
+    if close_now:
+        _close_kafka_entry(entry)
+
+
+def execute_kafka(task_data, batch_no):
+    bootstrap_servers = task_data.get('bootstrap_servers', 'localhost:9092')
+    topic = task_data.get('topic')
+    messages = task_data.get('messages', [])
+    config = task_data.get('config', {})
+
+    if not topic or not messages:
+        raise ValueError('Missing topic or messages')
+
+    entry, reused = acquire_kafka_producer(bootstrap_servers, config)
+    producer = entry['producer']
     sent_count = 0
+    healthy = False
     try:
         for msg in messages:
             if isinstance(msg, dict):
@@ -174,24 +511,208 @@ def execute_kafka(task_data, batch_no):
                 producer.send(topic, value=msg.encode('utf-8') if isinstance(msg, str) else msg)
             sent_count += 1
         producer.flush()
+        healthy = True
     finally:
-        producer.close()
-        if ssl_cafile_path and os.path.isfile(ssl_cafile_path) and _cert_cache_dir() not in ssl_cafile_path:
-            try:
-                os.remove(ssl_cafile_path)
-            except Exception:
-                pass
+        release_kafka_producer(entry, healthy=healthy)
+
+    return {'sent_count': sent_count, 'topic': topic, 'producer_reused': reused}
+
 
-    return {'sent_count': sent_count, 'topic': topic}
+def _disconnect_clickhouse(client):
+    try:
+        client.disconnect()
+    except Exception:
+        pass
+
+
+def _forget_clickhouse_client_locked(key):
+    """在持有 _clickhouse_pool_lock 时调用：某 key 少了一个已打开的连接，唤醒等待者"""
+    n = _clickhouse_open.get(key, 0) - 1
+    if n > 0:
+        _clickhouse_open[key] = n
+    else:
+        _clickhouse_open.pop(key, None)
+    _clickhouse_pool_lock.notify_all()
+
+
+def _evict_clickhouse_clients_locked(now):
+    """在持有 _clickhouse_pool_lock 时调用：摘除空闲超时的连接，返回待断开的条目"""
+    stale = []
+    for key in list(_clickhouse_idle):
+        items = _clickhouse_idle[key]
+        keep = [it for it in items if now - it['last_used'] <= CLICKHOUSE_POOL_IDLE_SECONDS]
+        for it in items:
+            if now - it['last_used'] > CLICKHOUSE_POOL_IDLE_SECONDS:
+                stale.append(it)
+                _forget_clickhouse_client_locked(key)
+        if keep:
+            _clickhouse_idle[key] = keep
+        else:
+            _clickhouse_idle.pop(key)
+    return stale
+
+
+def acquire_clickhouse_client(host, port, database, user, password):
+    """
+    从池中借出一个连接（无空闲则新建）；返回 (key, client, 是否命中池)。用完须调用 release_clickhouse_client。
+    该 key 已打开的连接数达到 CLICKHOUSE_MAX_OPEN_PER_KEY 时等待归还，超过 CLICKHOUSE_POOL_WAIT_SECONDS 抛 RuntimeError
+    """
+    _ensure_pool_reaper()
+    key = (host, port, database, user, hashlib.sha256(password.encode('utf-8')).hexdigest())
+    deadline = None
+    stale = []
+    with _clickhouse_pool_lock:
+        while True:
+            stale.extend(_evict_clickhouse_clients_locked(time.time()))
+            items = _clickhouse_idle.get(key)
+            item = items.pop() if items else None
+            if items is not None and not items:
+                _clickhouse_idle.pop(key, None)
+            if item or _clickhouse_open.get(key, 0) < CLICKHOUSE_MAX_OPEN_PER_KEY:
+                break
+            if deadline is None:
+                deadline = time.time() + CLICKHOUSE_POOL_WAIT_SECONDS
+                _clickhouse_pool_stats['waits'] += 1
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                _clickhouse_pool_stats['wait_timeouts'] += 1
+                break
+            _clickhouse_pool_lock.wait(remaining)
+        if item is None and _clickhouse_open.get(key, 0) < CLICKHOUSE_MAX_OPEN_PER_KEY:
+            _clickhouse_open[key] = _clickhouse_open.get(key, 0) + 1
+            opened = True
+        else:
+            opened = False
+        if item or opened:
+            _clickhouse_pool_stats['hits' if item else 'misses'] += 1
+    for it in stale:
+        _disconnect_clickhouse(it['client'])
+    if item:
+        return key, item['client'], True
+    if not opened:
+        raise RuntimeError(f'ClickHouse {host}:{port} 连接数已达上限 {CLICKHOUSE_MAX_OPEN_PER_KEY}，'
+                           f'等待 {CLICKHOUSE_POOL_WAIT_SECONDS:g} 秒仍无空闲连接')
+    try:
+        client = Client(host=host, port=port, database=database, user=user, password=password)
+    except Exception:
+        with _clickhouse_pool_lock:
+            _forget_clickhouse_client_locked(key)
+        raise
+    return key, client, False
+
+
+def release_clickhouse_client(key, client, healthy=True):
+    """归还连接；连接异常或池已满时直接断开"""
+    with _clickhouse_pool_lock:
+        if healthy and sum(len(v) for v in _clickhouse_idle.values()) < CLICKHOUSE_POOL_MAX_SIZE:
+            _clickhouse_idle.setdefault(key, []).append({'client': client, 'last_used': time.time()})
+            _clickhouse_pool_lock.notify_all()
+            return
+        _forget_clickhouse_client_locked(key)
+    _disconnect_clickhouse(client)
+
+
+def _is_clickhouse_connection_error(e):
+    """连接层错误（断线、超时等），而非服务端返回的 SQL 错误"""
+    return isinstance(e, (ch_errors.NetworkError, ch_errors.SocketTimeoutError, EOFError, OSError))
+
+
+def _quote_identifier(name):
+    """库/表/列名加反引号（支持 db.table）"""
+    return '.'.join('`%s`' % part.strip().strip('`').replace('`', '') for part in str(name).split('.'))
+
+
+def _parse_clickhouse_datetime(v):
+    if isinstance(v, datetime):
+        return v
+    v = str(v).strip()
+    if v.isdigit():
+        ts = int(v)
+        return datetime.fromtimestamp(ts / 1000 if len(v) >= 13 else ts)
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            return datetime.strptime(v, fmt)
+        except ValueError:
+            continue
+    return datetime.fromisoformat(v)
+
+
+def _parse_clickhouse_date(v):
+    if isinstance(v, date):
+        return v
+    v = str(v).strip()
+    if len(v) > 10 or v.isdigit():
+        return _parse_clickhouse_datetime(v).date()
+    return datetime.strptime(v, '%Y-%m-%d').date()
+
+
+def _clickhouse_converter(ch_type):
+    """按 ClickHouse 列类型返回文本值 -> Python 值的转换函数；字符串等无需转换的类型返回 None"""
+    t = ch_type.strip()
+    nullable = False
+    if t.startswith('LowCardinality(') and t.endswith(')'):
+        t = t[len('LowCardinality('):-1]
+    if t.startswith('Nullable(') and t.endswith(')'):
+        t = t[len('Nullable('):-1]
+        nullable = True
+    if re.match(r'^U?Int\d+$', t):
+        conv = int
+    elif t.startswith('Float'):
+        conv = float
+    elif t.startswith('Decimal'):
+        conv = Decimal
+    elif t.startswith('DateTime'):
+        conv = _parse_clickhouse_datetime
+    elif t in ('Date', 'Date32'):
+        conv = _parse_clickhouse_date
+    elif t == 'Bool':
+        conv = lambda v: str(v).strip().lower() in ('1', 'true')
+    elif t == 'UUID':
+        conv = lambda v: uuid.UUID(str(v))
+    else:
+        conv = None
+    if not nullable:
+        return conv
+    return lambda v: None if v is None or str(v).strip().lower() in ('', 'null') else (conv(v) if conv else v)
+
+
+def _convert_clickhouse_column(values, conv):
+    """逐列转换；同一列常有大量重复值（批内不变参数），按值缓存转换结果"""
+    if conv is None:
+        return values
+    cache = {}
+    out = []
+    for v in values:
+        try:
+            out.append(cache[v])
+        except KeyError:
+            cache[v] = conv(v)
+            out.append(cache[v])
+        except TypeError:
+            out.append(conv(v))
+    return out
+
+
+def _numpy_dtype(ch_type):
+    """非 Nullable 的 Int/UInt/Float 列返回对应 NumPy dtype，其余类型返回 None"""
+    m = re.match(r'^(U?Int|Float)(8|16|32|64)$', ch_type.strip())
+    if not m or (m.group(1) == 'Float' and m.group(2) not in ('32', '64')):
+        return None
+    return {'Int': 'int', 'UInt': 'uint', 'Float': 'float'}[m.group(1)] + m.group(2)
+
+
+def _to_numpy_column(values, dtype):
+    return np.array(values, dtype=dtype)
 
 
 def execute_clickhouse(task_data, batch_no):
     host = task_data.get('host', 'localhost')
     port = task_data.get('port', 9000)
     sqls = task_data.get('sqls', [])
+    insert = task_data.get('insert')
     config = task_data.get('config', {}) or {}
 
-    if not sqls:
+    if not sqls and not insert:
         raise ValueError('Missing sqls')
 
     user = config.get('user') or config.get('username')
@@ -204,25 +725,71 @@ def execute_clickhouse(task_data, batch_no):
     user = user or 'default'
     password = str(password) if password is not None else ''
     database = (config.get('database') or '').strip() or 'default'
+    port = int(port) if port is not None else 9000
+    key, client, hit = acquire_clickhouse_client(host, port, database, user, password)
+    healthy = True
+    executed = 0
+
+    def execute_one(*args, **kwargs):
+        nonlocal client
+        try:
+            return client.execute(*args, **kwargs)
+        except Exception as e:
+            # 池中复用的连接可能已被服务端断开：首条语句遇到连接层错误时换新连接重试一次（新连接沿用原连接的名额）
+            if not (hit and executed == 0 and _is_clickhouse_connection_error(e)):
+                raise
+            _disconnect_clickhouse(client)
+            with _clickhouse_pool_lock:
+                _clickhouse_pool_stats['reconnects'] += 1
+            client = Client(host=host, port=port, database=database, user=user, password=password)
+            return client.execute(*args, **kwargs)
+
     try:
-        client = Client(
-            host=host,
-            port=int(port) if port is not None else 9000,
-            database=database,
-            user=user,
-            password=password
-        )
-        executed = 0
-        for sql in sqls:
-            client.execute(sql)
+        result = {'host': host}
+        if insert:
+            # 列式批量写入：整批一次 INSERT，按表结构把文本值转换为列类型
+            table = _quote_identifier(insert['table'])
+            columns = insert.get('columns') or []
+            data = task_data.get('data') or []
+            if len(columns) != len(data):
+                raise ValueError('columns 与 data 列数不一致')
+            types = {row[0]: row[1] for row in execute_one(f'DESCRIBE TABLE {table}')}
             executed += 1
-        return {'executed_sqls': executed, 'host': host}
+            missing = [c for c in columns if c not in types]
+            if missing:
+                raise ValueError(f'表 {insert["table"]} 不存在列: {", ".join(missing)}')
+            convs = [_clickhouse_converter(types[c]) for c in columns]
+            data = [_convert_clickhouse_column(values, conv) for values, conv in zip(data, convs)]
+            # clickhouse-driver 的 use_numpy 对整条 INSERT 生效，字符串/日期/Nullable 等列需要 pandas 对象，
+            # 故仅当所有目标列都是数值列时启用，否则走普通列式写入
+            dtypes = [_numpy_dtype(types[c]) for c in columns]
+            use_numpy = bool(task_data.get('use_numpy')) and np is not None and all(dtypes)
+            settings = None
+            if use_numpy:
+                data = [_to_numpy_column(values, dtype) for values, dtype in zip(data, dtypes)]
+                settings = {'use_numpy': True}
+            cols = ', '.join(_quote_identifier(c) for c in columns)
+            execute_one(f'INSERT INTO {table} ({cols}) VALUES', data, columnar=True, settings=settings)
+            executed += 1
+            result.update({'inserted_rows': len(data[0]) if data else 0, 'use_numpy': use_numpy})
+        else:
+            for sql in sqls:
+                execute_one(sql)
+                executed += 1
+            result['executed_sqls'] = executed
+        with _clickhouse_pool_lock:
+            stats = dict(_clickhouse_pool_stats)
+        result['pool'] = dict(stats, hit=hit)
+        return result
     except Exception as e:
+        healthy = isinstance(e, (ch_errors.ServerException, ValueError))
         err_msg = str(e)
         if 'password' in err_msg.lower() and ('incorrect' in err_msg.lower() or 'no user' in err_msg.lower()):
             hint = ' (收到密码长度: %d，若为 0 表示未传到 Agent)' % len(password)
             raise RuntimeError(err_msg + hint) from e
         raise
+    finally:
+        release_clickhouse_client(key, client, healthy=healthy)
 
 
 if __name__ == '__main__':
@@ -1,38 +1,331 @@
 """
 Agent客户端 - 支持连接缓存，避免每次轮询重新建立连接
 """
+import random
+import socket
 import requests
 import threading
+import time
+from collections import OrderedDict
 from datetime import datetime
-# Agent连接缓存: {url: {'session': session, 'last_check': datetime, 'status': 'ok'}}
-_agent_cache = {}
+from itertools import islice
+from urllib.parse import urlsplit, urlunsplit
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+try:
+    from config import AGENT_DISPATCH_CHUNK_SIZE
+except ImportError:
+    AGENT_DISPATCH_CHUNK_SIZE = 2000
+try:
+    from config import AGENT_RENDER_CHUNK_SIZE
+except ImportError:
+    AGENT_RENDER_CHUNK_SIZE = 20000
+try:
+    from config import AGENT_BREAKER_FAILURE_THRESHOLD, AGENT_BREAKER_OPEN_SECONDS
+except ImportError:
+    AGENT_BREAKER_FAILURE_THRESHOLD = 3  # 连续失败多少次后熔断
+    AGENT_BREAKER_OPEN_SECONDS = 30  # 熔断多久后放行一次试探请求
+try:
+    from config import AGENT_RETRY_MAX_ATTEMPTS, AGENT_RETRY_BASE_DELAY, AGENT_RETRY_MAX_DELAY
+except ImportError:
+    AGENT_RETRY_MAX_ATTEMPTS = 3
+    AGENT_RETRY_BASE_DELAY = 0.5
+    AGENT_RETRY_MAX_DELAY = 4
+try:
+    from config import AGENT_LATENCY_EWMA_ALPHA
+except ImportError:
+    AGENT_LATENCY_EWMA_ALPHA = 0.3  # 每条耗时 EWMA 的平滑系数，越大越看重最近几次
+try:
+    from config import AGENT_SESSION_CACHE_SIZE, AGENT_SESSION_IDLE_SECONDS
+except ImportError:
+    AGENT_SESSION_CACHE_SIZE = 64  # 最多缓存的 Agent session 数，超出时关闭最久未用的
+    AGENT_SESSION_IDLE_SECONDS = 600  # session 空闲超过该秒数后关闭
+try:
+    from config import AGENT_HTTP_POOL_CONNECTIONS, AGENT_HTTP_POOL_MAXSIZE, AGENT_HTTP_KEEPALIVE
+except ImportError:
+    AGENT_HTTP_POOL_CONNECTIONS = 4  # 每个 session 缓存的连接池（host）数
+    AGENT_HTTP_POOL_MAXSIZE = 32  # 到同一 Agent 的最大复用连接数（并发下发上限）
+    AGENT_HTTP_KEEPALIVE = True  # False 时每次请求后断开（Connection: close）
+# Agent连接缓存（LRU+TTL）: {url: {'session': session, 'adapter': HTTPAdapter, 'created_at': float, 'last_used': float,
+#                              'last_check': datetime, 'status': 'ok', 'features': set|None}}
+_agent_cache = OrderedDict()
 _cache_lock = threading.Lock()
+_session_evictions = 0
+# 熔断状态: {url: {'state': closed|open|half_open, 'failures': int, 'opened_at': float|None, 'last_error': str|None, 'probing': bool}}
+_breakers = {}
+_breaker_lock = threading.Lock()
+# 最近请求耗时与条数（EWMA）: {url: (秒, 条)}，二者之比为每条耗时，用于 Agent 组按速度分配条数
+_agent_latency = {}
+
+
+class AgentUnavailableError(Exception):
+    """Agent 处于熔断状态，请求未发出直接失败"""
 
 
 def _ensure_url(url):
-    """确保URL包含协议"""
+    """确保URL包含协议，并规范化为缓存键：协议与主机名小写、去掉默认端口与末尾斜杠，同一 Agent 的不同写法共用一个 session"""
     if not url:
         return url
     url = url.strip().rstrip('/')
-    if not url.startswith(('http://', 'https://')):
+    if not url.lower().startswith(('http://', 'https://')):
         url = 'http://' + url
-    return url
+    try:
+        parts = urlsplit(url)
+        scheme = parts.scheme.lower()
+        host = (parts.hostname or '').lower()
+        if ':' in host:
+            host = f'[{host}]'
+        port = parts.port
+    except ValueError:
+        return url
+    netloc = host if port is None or (scheme, port) in (('http', 80), ('https', 443)) else f'{host}:{port}'
+    if parts.username or parts.password:
+        netloc = parts.netloc.rsplit('@', 1)[0] + '@' + netloc
+    return urlunsplit((scheme, netloc, parts.path.rstrip('/'), parts.query, ''))
+
+
+def _new_agent_session():
+    """新建 Agent session：按配置设置连接池大小与 keep-alive（开启时附加 TCP keepalive，及早发现断开的长连接）"""
+    session = requests.Session()
+    session.headers.update({'Content-Type': 'application/json'})
+    if AGENT_HTTP_KEEPALIVE:
+        socket_options = [(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1), (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+        adapter = HTTPAdapter(pool_connections=AGENT_HTTP_POOL_CONNECTIONS, pool_maxsize=AGENT_HTTP_POOL_MAXSIZE)
+        adapter.init_poolmanager(AGENT_HTTP_POOL_CONNECTIONS, AGENT_HTTP_POOL_MAXSIZE, socket_options=socket_options)
+    else:
+        session.headers['Connection'] = 'close'
+        adapter = HTTPAdapter(pool_connections=AGENT_HTTP_POOL_CONNECTIONS, pool_maxsize=AGENT_HTTP_POOL_MAXSIZE)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session, adapter
+
+
+def _evict_sessions_locked(now):
+    """在持有 _cache_lock 时调用：淘汰空闲超时的 session，并按 LRU 淘汰超出 AGENT_SESSION_CACHE_SIZE 的部分。
+    淘汰只移出缓存不主动 close：其他线程可能仍在用该 session 发请求，连接池在 session 不再被引用时由 GC 回收"""
+    global _session_evictions
+    evicted = [b for b, e in _agent_cache.items() if now - e['last_used'] > AGENT_SESSION_IDLE_SECONDS]
+    evicted += list(_agent_cache)[len(evicted):len(_agent_cache) - AGENT_SESSION_CACHE_SIZE]
+    if not evicted:
+        return
+    for b in evicted:
+        _agent_cache.pop(b)
+        _session_evictions += 1
+    # 熔断状态随 session 一并清理，避免校验过的临时 URL 长期占用
+    with _breaker_lock:
+        for b in evicted:
+            _breakers.pop(b, None)
+            _agent_latency.pop(b, None)
 
 
 def get_agent_session(url):
     """获取Agent的缓存session，避免每次轮询重新建立连接"""
     url = _ensure_url(url)
     base = url.rstrip('/')
+    now = time.time()
     with _cache_lock:
-        if base not in _agent_cache:
-            session = requests.Session()
-            session.headers.update({'Content-Type': 'application/json'})
-            _agent_cache[base] = {
+        entry = _agent_cache.get(base)
+        if entry is None:
+            session, adapter = _new_agent_session()
+            entry = _agent_cache[base] = {
                 'session': session,
+                'adapter': adapter,
+                'created_at': now,
+                'last_used': now,
                 'last_check': None,
-                'status': 'unknown'
+                'status': 'unknown',
+                'features': None
             }
-        return _agent_cache[base]['session'], base
+        else:
+            entry['last_used'] = now
+            _agent_cache.move_to_end(base)
+        _evict_sessions_locked(now)
+        return entry['session'], base
+
+
+def _adapter_pool_stats(adapter):
+    """汇总 adapter 下各 urllib3 连接池的请求数与新建连接数"""
+    requests_count = connections = 0
+    pools = adapter.poolmanager.pools
+    for key in list(pools.keys()):
+        pool = pools.get(key)
+        if pool is not None:
+            requests_count += pool.num_requests
+            connections += pool.num_connections
+    return requests_count, connections
+
+
+def get_session_stats():
+    """session 缓存与各 Agent 的连接复用统计（供运行指标展示）"""
+    with _cache_lock:
+        entries = [(b, e['adapter'], e['created_at'], e['last_used']) for b, e in _agent_cache.items()]
+        evictions = _session_evictions
+    with _breaker_lock:
+        latency = dict(_agent_latency)
+    agents = {}
+    for base, adapter, created_at, last_used in entries:
+        req_count, conn_count = _adapter_pool_stats(adapter)
+        agents[base] = {
+            'requests': req_count,
+            'connections_opened': conn_count,
+            'reused': max(0, req_count - conn_count),
+            'reuse_ratio': round((req_count - conn_count) / req_count, 3) if req_count else None,
+            'ms_per_item': round(_latency_per_item(latency[base]) * 1000, 3) if latency.get(base) else None,
+            'created_at': datetime.fromtimestamp(created_at).isoformat(),
+            'last_used': datetime.fromtimestamp(last_used).isoformat(),
+        }
+    return {
+        'size': len(entries),
+        'max_size': AGENT_SESSION_CACHE_SIZE,
+        'idle_seconds': AGENT_SESSION_IDLE_SECONDS,
+        'pool_maxsize': AGENT_HTTP_POOL_MAXSIZE,
+        'evictions': evictions,
+        'agents': agents,
+    }
+
+
+def _get_breaker_locked(base):
+    b = _breakers.get(base)
+    if b is None:
+        b = _breakers[base] = {'state': 'closed', 'failures': 0, 'opened_at': None, 'last_error': None, 'probing': False}
+    return b
+
+
+def _breaker_acquire(base):
+    """请求前检查熔断：打开状态直接抛 AgentUnavailableError；超过 AGENT_BREAKER_OPEN_SECONDS 后只放行一个试探请求（半开）"""
+    with _breaker_lock:
+        b = _get_breaker_locked(base)
+        if b['state'] == 'closed':
+            return
+        if b['state'] == 'open' and time.time() - b['opened_at'] >= AGENT_BREAKER_OPEN_SECONDS:
+            b['state'] = 'half_open'
+            b['probing'] = False
+        if b['state'] == 'half_open' and not b['probing']:
+            b['probing'] = True
+            return
+        wait = max(0, int(AGENT_BREAKER_OPEN_SECONDS - (time.time() - (b['opened_at'] or 0))))
+        raise AgentUnavailableError(
+            f'Agent {base} 不可用（熔断中，最近连续失败 {b["failures"]} 次，约 {wait} 秒后重试）: {b["last_error"]}')
+
+
+def _breaker_record(base, ok, error=None, open_now=False):
+    """记录一次请求/探测结果：成功则关闭熔断；失败累计到阈值（或 open_now）则打开，半开试探失败立即重新打开"""
+    with _breaker_lock:
+        b = _get_breaker_locked(base)
+        b['probing'] = False
+        if ok:
+            b.update(state='closed', failures=0, opened_at=None, last_error=None)
+            return
+        b['failures'] += 1
+        b['last_error'] = error
+        if open_now or b['state'] == 'half_open' or b['failures'] >= AGENT_BREAKER_FAILURE_THRESHOLD:
+            b['state'] = 'open'
+            b['opened_at'] = time.time()
+
+
+def agent_available(url):
+    """Agent 当前是否可下发（熔断未打开，或已到试探时间）"""
+    base = _ensure_url(url)
+    with _breaker_lock:
+        b = _breakers.get(base)
+        return b is None or b['state'] != 'open' or time.time() - b['opened_at'] >= AGENT_BREAKER_OPEN_SECONDS
+
+
+def _record_latency(base, elapsed, count):
+    """按请求累计耗时与条数分别做 EWMA，二者之比为每条耗时（小块的固定开销不会被放大成很慢）"""
+    if count <= 0:
+        return
+    with _breaker_lock:
+        prev = _agent_latency.get(base)
+        if prev is None:
+            _agent_latency[base] = (elapsed, float(count))
+        else:
+            _agent_latency[base] = (prev[0] + AGENT_LATENCY_EWMA_ALPHA * (elapsed - prev[0]),
+                                    prev[1] + AGENT_LATENCY_EWMA_ALPHA * (count - prev[1]))
+
+
+def _latency_per_item(entry):
+    return entry[0] / entry[1] if entry and entry[1] else None
+
+
+def agent_weights(urls):
+    """按最近每条耗时计算各 Agent 的分配权重（越快越大）；尚无记录的 Agent 取已知 Agent 的平均速度"""
+    bases = [_ensure_url(u) for u in urls]
+    with _breaker_lock:
+        latencies = [_latency_per_item(_agent_latency.get(b)) for b in bases]
+    known = [lat for lat in latencies if lat]
+    default = sum(known) / len(known) if known else 1.0
+    return [1.0 / (lat or default) for lat in latencies]
+
+
+def split_by_weight(total, weights):
+    """把 total 条按权重拆分为各份条数（最大余数法，总和恰为 total）"""
+    wsum = sum(weights)
+    exact = [total * w / wsum for w in weights]
+    counts = [int(x) for x in exact]
+    rest = total - sum(counts)
+    for i in sorted(range(len(weights)), key=lambda i: exact[i] - counts[i], reverse=True)[:rest]:
+        counts[i] += 1
+    return counts
+
+
+def get_breaker_states():
+    """各 Agent 的熔断状态（供运行指标展示）"""
+    with _breaker_lock:
+        return {base: {k: v for k, v in b.items() if k != 'probing'} for base, b in _breakers.items()}
+
+
+def _request_not_sent(e):
+    """连接尚未建立（建连超时、拒绝连接、DNS 失败等）时请求一定未送达 Agent，可安全重试；
+    连接建立后的断开（Connection aborted 等）可能已送达，重试会重复写入"""
+    if isinstance(e, requests.ConnectTimeout):
+        return True
+    seen = set()
+    pending = [e]
+    while pending:
+        err = pending.pop()
+        if err is None or id(err) in seen:
+            continue
+        seen.add(id(err))
+        if isinstance(err, NewConnectionError):
+            return True
+        pending.extend([getattr(err, 'reason', None), err.__cause__, err.__context__])
+        pending.extend(a for a in getattr(err, 'args', ()) if isinstance(a, BaseException))
+    return False
+
+
+def _agent_request(method, url, path, token, timeout, **kwargs):
+    """
+    经熔断器向 Agent 发请求：请求未送达（连接未建立）时按指数退避重试，最多 AGENT_RETRY_MAX_ATTEMPTS 次；
+    连接失败、超时与网关错误计入熔断，Agent 正常返回（含任务执行失败）视为 Agent 可用
+    """
+    session, base = get_agent_session(url)
+    _breaker_acquire(base)
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            resp = session.request(method, base + path, headers={'X-Agent-Token': token}, timeout=timeout, **kwargs)
+        except requests.ConnectionError as e:
+            if attempt < AGENT_RETRY_MAX_ATTEMPTS and _request_not_sent(e):
+                delay = min(AGENT_RETRY_MAX_DELAY, AGENT_RETRY_BASE_DELAY * 2 ** (attempt - 1))
+                time.sleep(delay * random.uniform(0.5, 1))
+                continue
+            _breaker_record(base, False, str(e))
+            raise
+        except requests.RequestException as e:
+            _breaker_record(base, False, str(e))
+            raise
+        except Exception:
+            with _breaker_lock:
+                _get_breaker_locked(base)['probing'] = False
+            raise
+        if resp.status_code in (502, 504):
+            _breaker_record(base, False, f'{resp.status_code} {resp.text[:200]}')
+        else:
+            _breaker_record(base, True)
+        return resp
 
 
 def check_agent(url, token):
@@ -45,30 +338,44 @@ def check_agent(url, token):
             timeout=5
         )
         ok = resp.status_code == 200
+        detail = resp.json() if resp.text else {}
         with _cache_lock:
             if base in _agent_cache:
                 _agent_cache[base]['last_check'] = datetime.now()
                 _agent_cache[base]['status'] = 'ok' if ok else 'error'
-        return ok, resp.json() if resp.text else {}
+                if ok:
+                    _agent_cache[base]['features'] = set(detail.get('features') or [])
+        _breaker_record(base, ok, None if ok else f'health {resp.status_code}', open_now=not ok)
+        return ok, detail
     except Exception as e:
         with _cache_lock:
             if base in _agent_cache:
                 _agent_cache[base]['status'] = 'error'
+        _breaker_record(base, False, str(e), open_now=True)
         return False, {'error': str(e)}
 
 
-def execute_on_agent(url, token, task_type, task_data, batch_no=1):
-    """在Agent上执行任务"""
+def agent_supports(url, token, feature):
+    """Agent 是否声明支持某项能力（由 health 接口的 features 返回）；本进程尚未校验过该 Agent 时先校验一次"""
     session, base = get_agent_session(url)
-    resp = session.post(
-        base.rstrip('/') + '/api/agent/execute',
-        headers={'X-Agent-Token': token},
+    with _cache_lock:
+        features = _agent_cache.get(base, {}).get('features')
+    if features is None:
+        check_agent(url, token)
+        with _cache_lock:
+            features = _agent_cache.get(base, {}).get('features')
+    return bool(features) and feature in features
+
+
+def execute_on_agent(url, token, task_type, task_data, batch_no=1):
+    """在Agent上执行任务（经熔断器；Agent 已知不可用时抛 AgentUnavailableError）"""
+    resp = _agent_request(
+        'POST', url, '/api/agent/execute', token, 60,
         json={
             'task_type': task_type,
             'task_data': task_data,
             'batch_no': batch_no
-        },
-        timeout=60
+        }
     )
     if resp.status_code != 200:
         raise Exception(f'Agent error: {resp.status_code} {resp.text}')
@@ -80,3 +387,130 @@ def execute_on_agent(url, token, task_type, task_data, batch_no=1):
             err = err + '\n\n--- 堆栈 ---\n' + tb
         raise Exception(err)
     return data.get('result', {})
+
+
+class ChunkedDispatchError(Exception):
+    """分块下发中途失败；progress 记录已成功下发的块数与条数"""
+
+    def __init__(self, message, progress):
+        super().__init__(message)
+        self.progress = progress
+
+
+def _merge_result(merged, result):
+    """合并分块结果：数值字段累加，其余字段取最后一块"""
+    for k, v in (result or {}).items():
+        if isinstance(v, int) and not isinstance(v, bool):
+            merged[k] = merged.get(k, 0) + v
+        elif k != 'chunk_no':
+            merged[k] = v
+
+
+def merge_results(results):
+    """合并多个 Agent / 分块的执行结果，合并规则同分块结果"""
+    merged = {}
+    for result in results:
+        _merge_result(merged, result)
+    return merged
+
+
+def execute_chunked_on_agent(url, token, task_type, task_data, items_key, items, batch_no=1, chunk_size=None, on_progress=None, transform=None):
+    """
+    将惰性生成的 items（消息、SQL 或行）按 chunk_size 分块依次下发到 Agent，内存中只保留当前一块。
+    transform 可将每块转换为下发格式（如行转列）；每块成功后回调 on_progress(progress)；
+    返回合并后的结果（数值字段累加），并带 chunks/items 进度。
+    """
+    chunk_size = chunk_size or AGENT_DISPATCH_CHUNK_SIZE
+    progress = {'chunks': 0, 'items': 0}
+    merged = {}
+    it = iter(items)
+    while True:
+        chunk = list(islice(it, chunk_size))
+        if not chunk:
+            break
+        payload = dict(task_data)
+        payload[items_key] = transform(chunk) if transform else chunk
+        payload['chunk_no'] = progress['chunks'] + 1
+        started = time.time()
+        try:
+            result = execute_on_agent(url, token, task_type, payload, batch_no)
+        except Exception as e:
+            raise ChunkedDispatchError(
+                f'第 {payload["chunk_no"]} 块下发失败（已完成 {progress["chunks"]} 块 / {progress["items"]} 条）: {e}',
+                dict(progress)
+            ) from e
+        _record_latency(_ensure_url(url), time.time() - started, len(chunk))
+        _merge_result(merged, result)
+        progress['chunks'] += 1
+        progress['items'] += len(chunk)
+        if on_progress:
+            on_progress(dict(progress))
+    merged.update(progress)
+    return merged
+
+
+def execute_rendered_on_agent(url, token, task_type, task_data, render_spec, total, batch_no=1, chunk_size=None, on_progress=None, offset=0):
+    """
+    Agent 端渲染：只下发模板与参数配置（render_spec），由 Agent 本地渲染本批序号 [offset, offset + total) 的条目。
+    按 chunk_size 切分为多个序号区间依次下发，单次请求耗时可控；进度与结果合并方式同 execute_chunked_on_agent。
+    """
+    chunk_size = chunk_size or AGENT_RENDER_CHUNK_SIZE
+    progress = {'chunks': 0, 'items': 0}
+    merged = {}
+    for start in range(offset, offset + total, chunk_size):
+        count = min(chunk_size, offset + total - start)
+        payload = dict(task_data)
+        payload['render'] = dict(render_spec, start=start, count=count)
+        payload['chunk_no'] = progress['chunks'] + 1
+        started = time.time()
+        try:
+            result = execute_on_agent(url, token, task_type, payload, batch_no)
+        except Exception as e:
+            raise ChunkedDispatchError(
+                f'第 {payload["chunk_no"]} 块执行失败（已完成 {progress["chunks"]} 块 / {progress["items"]} 条）: {e}',
+                dict(progress)
+            ) from e
+        _record_latency(_ensure_url(url), time.time() - started, count)
+        _merge_result(merged, result)
+        progress['chunks'] += 1
+        progress['items'] += count
+        if on_progress:
+            on_progress(dict(progress))
+    merged.update(progress)
+    return merged
+
+
+def submit_job_on_agent(url, token, task_type, task_data, batch_no=1, callback_url=None):
+    """向 Agent 异步提交任务，立即返回 job_id（Agent 排队已满或出错时抛异常）"""
+    body = {
+        'task_type': task_type,
+        'task_data': task_data,
+        'batch_no': batch_no
+    }
+    if callback_url:
+        body['callback_url'] = callback_url
+    resp = _agent_request('POST', url, '/api/agent/jobs', token, 10, json=body)
+    if resp.status_code not in (200, 202):
+        raise Exception(f'Agent error: {resp.status_code} {resp.text}')
+    data = resp.json()
+    if not data.get('success') or not data.get('job_id'):
+        raise Exception(data.get('error', 'Unknown error'))
+    return data['job_id']
+
+
+def get_job_on_agent(url, token, job_id):
+    """查询 Agent 上异步任务的状态；任务不存在（如 Agent 重启）时返回 None"""
+    resp = _agent_request('GET', url, '/api/agent/jobs/' + job_id, token, 5)
+    if resp.status_code == 404:
+        return None
+    if resp.status_code != 200:
+        raise Exception(f'Agent error: {resp.status_code} {resp.text}')
+    return resp.json().get('job')
+
+
+def format_job_error(job):
+    """把失败任务的错误与堆栈拼成与同步执行一致的错误信息"""
+    err = job.get('error') or 'Unknown error'
+    if job.get('traceback'):
+        err = err + '\n\n--- 堆栈 ---\n' + job['traceback']
+    return err
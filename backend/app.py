@@ -2,16 +2,22 @@
 通用工具类Web服务
 提供时间戳转换、JSON格式化校验、编码转换、文件MD5值计算、网段和IP归属关系判断、Cron表达式解析、数据构造任务等功能
 """
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, g
 from flask_cors import CORS
 import json
 import time
 import traceback
+import atexit
+import bisect
 import hashlib
+import heapq
 import base64
 import ipaddress
 import os
+import socket
 import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from functools import wraps
 from croniter import croniter
@@ -20,15 +26,99 @@ import jwt
 from werkzeug.security import check_password_hash, generate_password_hash
 
 from pymysql.err import IntegrityError
-from database.db import get_db, init_db, is_admin_ip
-from agent_client import check_agent, execute_on_agent
-from template_utils import extract_params, render_kafka_messages, render_clickhouse_sqls
+from database.db import get_db, get_connection, get_pool_stats, init_db, is_admin_ip
+from agent_client import (
+    check_agent, agent_supports, execute_chunked_on_agent, execute_rendered_on_agent, ChunkedDispatchError,
+    submit_job_on_agent, get_job_on_agent, format_job_error, get_breaker_states,
+    get_session_stats, agent_available, agent_weights, split_by_weight, merge_results,
+)
+from template_utils import (
+    extract_params, iter_kafka_messages, iter_kafka_payloads, kafka_template_is_object, iter_clickhouse_sqls,
+    parse_columnar_template, iter_clickhouse_rows,
+)
 
 try:
     from config import JWT_SECRET, JWT_EXPIRE_DAYS
 except ImportError:
     JWT_SECRET = 'common-utils-jwt-secret'
     JWT_EXPIRE_DAYS = 7
+try:
+    from config import AGENT_CALLBACK_BASE_URL
+except ImportError:
+    AGENT_CALLBACK_BASE_URL = None  # 如 http://10.0.0.1:5000，配置后 Agent 异步任务完成时回调本服务
+try:
+    from config import AGENT_JOB_POLL_INTERVAL, AGENT_JOB_TIMEOUT
+except ImportError:
+    AGENT_JOB_POLL_INTERVAL = 2
+    AGENT_JOB_TIMEOUT = 3600
+try:
+    from config import SCHEDULER_RECONCILE_SECONDS
+except ImportError:
+    SCHEDULER_RECONCILE_SECONDS = 30  # 调度器与数据库对账间隔（秒），其他实例启停的任务最迟在此间隔后生效
+try:
+    from config import SCHEDULER_MODE
+except ImportError:
+    # leader：多进程/多机通过 MySQL GET_LOCK 选主，仅主节点调度；sharded：各节点心跳注册，按任务 id 一致性哈希分片调度；
+    # all：每个进程都调度全部任务（靠认领表去重）
+    SCHEDULER_MODE = 'leader'
+try:
+    from config import SCHEDULER_NODE_TIMEOUT_SECONDS, SCHEDULER_VNODES
+except ImportError:
+    SCHEDULER_NODE_TIMEOUT_SECONDS = 10  # sharded 模式：节点心跳超过该秒数未更新视为下线
+    SCHEDULER_VNODES = 64  # sharded 模式：每个节点在哈希环上的虚拟节点数
+try:
+    from config import SCHEDULER_LOCK_NAME, SCHEDULER_LEADER_HEARTBEAT_SECONDS, SCHEDULER_LEADER_TIMEOUT_SECONDS
+except ImportError:
+    SCHEDULER_LOCK_NAME = 'common_utils.scheduler'
+    SCHEDULER_LEADER_HEARTBEAT_SECONDS = 2  # 主节点心跳 / 备节点抢锁间隔
+    SCHEDULER_LEADER_TIMEOUT_SECONDS = 10  # 选主连接的 wait_timeout：主节点所在机器宕机时 MySQL 最迟在此时间后释放锁
+try:
+    from config import SCHEDULER_CHANGE_POLL_SECONDS
+except ImportError:
+    SCHEDULER_CHANGE_POLL_SECONDS = 2  # 检查其他进程是否修改了任务的间隔（秒）
+SCHEDULER_LEAD_SECONDS = 2  # 提前多少秒认领本次执行（认领后到点再交给执行线程池）
+SCHEDULER_MISFIRE_GRACE_SECONDS = 5  # 超过计划时间多少秒仍未触发则跳过本次
+AUTO_STOP_FAILURES = 3  # 连续失败多少次后自动停止任务
+try:
+    from config import TASK_SNAPSHOT_TTL_SECONDS
+except ImportError:
+    TASK_SNAPSHOT_TTL_SECONDS = 60  # 任务快照最长缓存时间，兜底其他进程对 Agent/证书的修改
+try:
+    from config import TASK_RUN_WORKERS, TASK_RUN_BACKLOG_LIMIT
+except ImportError:
+    TASK_RUN_WORKERS = 16  # 执行计划任务的线程数上限
+    TASK_RUN_BACKLOG_LIMIT = 10  # overlap_policy=queue 时每个任务最多排队的执行数
+try:
+    from config import USER_CACHE_TTL_SECONDS
+except ImportError:
+    USER_CACHE_TTL_SECONDS = 30  # 登录用户信息缓存秒数，兜底其他进程对用户的修改
+try:
+    from config import SITE_CONFIG_CACHE_SECONDS
+except ImportError:
+    SITE_CONFIG_CACHE_SECONDS = 30  # 站点配置（菜单、公告）缓存秒数，兜底其他进程的修改
+try:
+    from config import EXECUTION_RETENTION_DAYS, EXECUTION_HOURLY_RETENTION_DAYS
+except ImportError:
+    EXECUTION_RETENTION_DAYS = 0  # 执行记录明细保留天数，更早的压缩为按小时汇总（不可恢复，需显式开启）；0 表示不压缩
+    EXECUTION_HOURLY_RETENTION_DAYS = 90  # 按小时汇总保留天数，更早的合并为按天汇总；0 表示不合并
+try:
+    from config import EXECUTION_RETENTION_INTERVAL_SECONDS, EXECUTION_RETENTION_BATCH
+except ImportError:
+    EXECUTION_RETENTION_INTERVAL_SECONDS = 3600  # 执行记录压缩间隔（秒）
+    EXECUTION_RETENTION_BATCH = 5000  # 压缩时每个事务处理的执行记录 id 范围
+EXECUTION_RETENTION_LOCK_NAME = 'common_utils.execution_retention'
+EXECUTIONS_PAGE_LIMIT = 100  # 执行记录每页默认条数
+EXECUTIONS_PAGE_MAX = 500
+try:
+    from config import EXECUTION_WRITE_BATCH, EXECUTION_WRITE_INTERVAL, EXECUTION_WRITE_MAX_PENDING
+except ImportError:
+    EXECUTION_WRITE_BATCH = 200  # 执行记录缓冲达到该条数立即批量写入
+    EXECUTION_WRITE_INTERVAL = 0.5  # 执行记录缓冲最长停留秒数
+    EXECUTION_WRITE_MAX_PENDING = 10000  # 数据库不可用时最多缓冲的执行记录数，超出丢弃最早的
+try:
+    from config import AGENT_PROBE_WORKERS
+except ImportError:
+    AGENT_PROBE_WORKERS = 16  # Agent 状态刷新时的并发探测线程数
 
 app = Flask(__name__)
 CORS(app)
@@ -41,6 +131,48 @@ _task_stop_flags = {}
 _agent_status_thread = None
 _scheduled_run_at = {}  # task_id -> next_run.timestamp()，避免同一计划时间重复调度
 _scheduled_run_lock = threading.Lock()
+_user_cache = {}  # user_id -> (用户信息, 过期时间戳)
+_user_cache_lock = threading.Lock()
+_site_config_cache = {}  # config_key -> {value, updated_at, loaded_at, responses: {名称: (body, etag)}}
+_site_config_lock = threading.Lock()
+_task_snapshots = {}  # task_id -> 任务快照 {task, agents, agent_ids, cert_id, param_config, connector_config, cert, loaded_at}
+_task_snapshot_lock = threading.Lock()
+_agent_status = {}  # agent_id -> 最近一次状态刷新结果（online/offline），供执行时挑选 Agent 组成员
+_pending_agent_jobs = {}  # job_id -> 已提交到 Agent 的异步任务 {task_id, batch_no, url, token, records_count, executed_at, submitted_at}
+_pending_agent_jobs_lock = threading.Lock()
+_agent_job_poller = None
+_agent_refresh_stats = {  # Agent 状态刷新统计，见 /api/metrics
+    'cycles': 0, 'last_cycle_seconds': None, 'max_cycle_seconds': None, 'last_cycle_at': None,
+    'agents': 0, 'online': 0, 'last_error': None,
+}
+_agent_refresh_stats_lock = threading.Lock()
+_execution_buffer = []  # 待写入的执行记录 (task_id, batch_no, success, result_message, records_count, executed_at)
+_execution_cond = threading.Condition()
+_execution_flush_lock = threading.Lock()  # 同一时间只有一个线程在写入，保证同一任务的记录按顺序落库
+_execution_writer = None
+_execution_writer_stats = {'queued': 0, 'written': 0, 'flushes': 0, 'last_flush_rows': 0, 'last_flush_seconds': None, 'dropped': 0,
+                           'errors': 0, 'last_error': None}
+_retention_thread = None
+_retention_stats = {'runs': 0, 'last_run_at': None, 'last_run_seconds': None, 'compacted': 0, 'hourly_merged': 0, 'last_error': None}
+_retention_stats_lock = threading.Lock()
+# 调度器：最小堆 (触发时间戳, task_id, version)，_sched_entries 为 task_id -> {cron, iter, version, next_run}
+_sched_heap = []
+_sched_entries = {}
+_sched_cond = threading.Condition()
+_launch_heap = []  # 已认领、待到点执行: (触发时间戳, task_id, 计划时间, schedule_key)
+_run_executor = None
+_run_lock = threading.Lock()
+_task_runs = {}  # task_id -> {'inflight': 在途执行数, 'backlog': deque[(计划时间, schedule_key)]}
+_run_stats = {'submitted': 0, 'waiting': 0, 'active': 0, 'completed': 0, 'skipped': 0, 'backlog': 0}
+_scheduler_node = f'{socket.gethostname()}:{os.getpid()}'
+_scheduler_active = threading.Event()  # 本进程当前是否参与调度（leader 模式为是否主节点，sharded/all 模式始终为是）
+_leader_conn = None
+_leader_thread = None
+_shard_ring = None  # sharded 模式：当前存活节点构成的一致性哈希环
+_shard_nodes = ()
+_sched_force_reconcile = threading.Event()  # 分片成员变化等需要立即对账时置位
+_scheduler_stats = {'is_leader': False, 'leader_since': None, 'leader_changes': 0, 'rebalances': 0, 'fired': 0, 'misfires': 0, 'reconciles': 0, 'last_reconcile_at': None,
+                    'last_reconcile_seconds': None, 'last_error': None}
 
 
 def get_client_ip():
@@ -57,28 +189,53 @@ def get_client_ip():
     return raw.split(',')[0].strip() or '127.0.0.1'
 
 
+def _load_user(uid):
+    """按 id 读取用户（带 USER_CACHE_TTL_SECONDS 缓存），不存在返回 None"""
+    now = time.time()
+    with _user_cache_lock:
+        hit = _user_cache.get(uid)
+    if hit and hit[1] > now:
+        return hit[0]
+    with get_db() as conn:
+        with conn.cursor() as cur:
+            cur.execute('SELECT id, username, is_admin FROM users WHERE id = %s', (uid,))
+            row = cur.fetchone()
+    user = {'id': row['id'], 'username': row['username'], 'is_admin': bool(row.get('is_admin'))} if row else None
+    with _user_cache_lock:
+        if len(_user_cache) >= 1024:
+            for k in [k for k, v in _user_cache.items() if v[1] <= now]:
+                del _user_cache[k]
+        _user_cache[uid] = (user, now + USER_CACHE_TTL_SECONDS)
+    return user
+
+
+def invalidate_user_cache(uid=None):
+    """用户信息修改后调用：失效该用户（不传时失效全部）的缓存"""
+    with _user_cache_lock:
+        if uid is None:
+            _user_cache.clear()
+        else:
+            _user_cache.pop(uid, None)
+
+
 def get_current_user():
-    """从 Authorization: Bearer <token> 解析出当前用户，无效或缺失返回 None"""
+    """从 Authorization: Bearer <token> 解析出当前用户，无效或缺失返回 None；同一请求内只解析一次"""
+    if '_current_user' in g:
+        user = g._current_user
+        return dict(user) if user else None
+    user = None
     auth = request.headers.get('Authorization')
-    if not auth or not auth.startswith('Bearer '):
-        return None
-    token = auth[7:].strip()
-    if not token:
-        return None
-    try:
-        payload = jwt.decode(token, JWT_SECRET, algorithms=['HS256'])
-        uid = payload.get('user_id')
-        if not uid:
-            return None
-        with get_db() as conn:
-            with conn.cursor() as cur:
-                cur.execute('SELECT id, username, is_admin FROM users WHERE id = %s', (uid,))
-                row = cur.fetchone()
-        if not row:
-            return None
-        return {'id': row['id'], 'username': row['username'], 'is_admin': bool(row.get('is_admin'))}
-    except (jwt.InvalidTokenError, jwt.ExpiredSignatureError):
-        return None
+    token = auth[7:].strip() if auth and auth.startswith('Bearer ') else ''
+    if token:
+        try:
+            payload = jwt.decode(token, JWT_SECRET, algorithms=['HS256'])
+            uid = payload.get('user_id')
+            if uid:
+                user = _load_user(uid)
+        except (jwt.InvalidTokenError, jwt.ExpiredSignatureError):
+            pass
+    g._current_user = user
+    return dict(user) if user else None
 
 
 def require_login(f):
@@ -225,6 +382,8 @@ def update_profile():
                 params.append(user['id'])
                 with conn.cursor() as cur:
                     cur.execute('UPDATE users SET ' + ', '.join(updates) + ' WHERE id = %s', params)
+        invalidate_user_cache(user['id'])
+        g.pop('_current_user', None)
         return jsonify({'success': True})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -270,6 +429,9 @@ def update_user(uid):
                 if not cur.fetchone():
                     return jsonify({'error': '用户不存在'}), 404
                 cur.execute('UPDATE users SET is_admin = %s WHERE id = %s', (1 if is_admin else 0, uid))
+        invalidate_user_cache(uid)
+        if uid == user['id']:
+            g.pop('_current_user', None)
         return jsonify({'success': True})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -289,17 +451,35 @@ DEFAULT_MENU_ITEMS = [
 ]
 
 
-def _get_site_config(key, default=None):
+def _load_site_config(key):
+    """读取站点配置（带 SITE_CONFIG_CACHE_SECONDS 缓存），返回缓存项 {value, updated_at, loaded_at, responses}"""
+    now = time.time()
+    with _site_config_lock:
+        entry = _site_config_cache.get(key)
+    if entry and now - entry['loaded_at'] < SITE_CONFIG_CACHE_SECONDS:
+        return entry
+    value, updated_at = None, None
     try:
         with get_db() as conn:
             with conn.cursor() as cur:
-                cur.execute('SELECT config_value FROM site_config WHERE config_key = %s', (key,))
+                cur.execute('SELECT config_value, updated_at FROM site_config WHERE config_key = %s', (key,))
                 row = cur.fetchone()
-        if row and row.get('config_value'):
-            return json.loads(row['config_value'])
+        if row:
+            updated_at = row.get('updated_at')
+            if row.get('config_value'):
+                value = json.loads(row['config_value'])
     except Exception:
-        pass
-    return default
+        # 读取失败不缓存，沿用旧值（若有）
+        return entry or {'value': None, 'updated_at': None, 'loaded_at': 0, 'responses': {}}
+    entry = {'value': value, 'updated_at': updated_at, 'loaded_at': now, 'responses': {}}
+    with _site_config_lock:
+        _site_config_cache[key] = entry
+    return entry
+
+
+def _get_site_config(key, default=None):
+    value = _load_site_config(key)['value']
+    return default if value is None else value
 
 
 def _set_site_config(key, value):
@@ -312,12 +492,29 @@ def _set_site_config(key, value):
                 (key, val_str)
             )
         conn.commit()
-
-
-@app.route('/api/site/menu', methods=['GET'])
-def get_site_menu():
-    """获取菜单配置（顺序、是否可见），不需登录。与默认菜单合并，确保首页等默认项始终存在且可编辑/移动。"""
-    stored = _get_site_config('menu_items') or []
+    with _site_config_lock:
+        _site_config_cache.pop(key, None)
+
+
+def _site_config_response(key, build):
+    """按缓存的站点配置返回 JSON 响应：响应体与 ETag 随配置缓存预先生成，If-None-Match/If-Modified-Since 命中时返回 304"""
+    entry = _load_site_config(key)
+    cached = entry['responses'].get(build.__name__)
+    if cached is None:
+        body = json.dumps({'success': True, 'data': build(entry['value'])}, ensure_ascii=False)
+        cached = (body, hashlib.md5(body.encode('utf-8')).hexdigest())
+        entry['responses'][build.__name__] = cached
+    resp = Response(cached[0], mimetype='application/json')
+    resp.set_etag(cached[1])
+    if entry['updated_at']:
+        resp.last_modified = entry['updated_at'].astimezone()  # MySQL DATETIME 为本地时间
+    resp.cache_control.no_cache = True
+    return resp.make_conditional(request)
+
+
+def _build_site_menu(stored):
+    """与默认菜单合并，确保首页等默认项始终存在且可编辑/移动"""
+    stored = stored or []
     by_path = {it.get('path'): it for it in stored if isinstance(it, dict) and it.get('path')}
     result = []
     for i, d in enumerate(DEFAULT_MENU_ITEMS):
@@ -346,7 +543,19 @@ def get_site_menu():
                 'visible': s.get('visible', True)
             })
     result.sort(key=lambda x: (x.get('sort_order', 999), x.get('path', '')))
-    return jsonify({'success': True, 'data': result})
+    return result
+
+
+def _build_site_announcement(obj):
+    if not obj or not obj.get('content'):
+        return None
+    return {'content': obj.get('content'), 'updated_at': obj.get('updated_at')}
+
+
+@app.route('/api/site/menu', methods=['GET'])
+def get_site_menu():
+    """获取菜单配置（顺序、是否可见），不需登录。与默认菜单合并，确保首页等默认项始终存在且可编辑/移动。"""
+    return _site_config_response('menu_items', _build_site_menu)
 
 
 @app.route('/api/site/menu', methods=['PUT'])
@@ -372,10 +581,7 @@ def update_site_menu():
 @app.route('/api/site/announcement', methods=['GET'])
 def get_site_announcement():
     """获取当前公告（不需登录）；无新公告时旧公告一直显示"""
-    obj = _get_site_config('announcement')
-    if not obj or not obj.get('content'):
-        return jsonify({'success': True, 'data': None})
-    return jsonify({'success': True, 'data': {'content': obj.get('content'), 'updated_at': obj.get('updated_at')}})
+    return _site_config_response('announcement', _build_site_announcement)
 
 
 @app.route('/api/site/announcement', methods=['POST'])
@@ -921,6 +1127,7 @@ def update_agent(aid):
                     (name, url, token, kafka_val, aid)
                 )
             conn.commit()
+        invalidate_task_snapshot(agent_id=aid)
         return jsonify({'success': True})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -943,6 +1150,7 @@ def delete_agent(aid):
             with conn.cursor() as cur:
                 cur.execute('DELETE FROM agents WHERE id = %s', (aid,))
             conn.commit()
+        invalidate_task_snapshot(agent_id=aid)
         return jsonify({'success': True})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -1007,12 +1215,45 @@ def list_data_tasks():
                 item['param_config'] = json.loads(item['param_config']) if isinstance(item['param_config'], str) else item['param_config']
             if item.get('connector_config'):
                 item['connector_config'] = json.loads(item['connector_config']) if isinstance(item['connector_config'], str) else item['connector_config']
+            item['agent_ids'] = _task_agent_ids(item)
             tasks.append(item)
         return jsonify({'success': True, 'data': tasks})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
+def _check_task_agents(cur, user, agent_ids):
+    """校验任务使用的 Agent 均存在且（非管理员时）为本人创建；不通过时返回错误响应"""
+    cur.execute(
+        f'SELECT id, creator_user_id FROM agents WHERE id IN ({",".join(["%s"] * len(agent_ids))})',
+        agent_ids
+    )
+    rows = {r['id']: r for r in cur.fetchall()}
+    for i in agent_ids:
+        if i not in rows:
+            return jsonify({'error': 'Agent不存在'}), 400
+        if not user.get('is_admin') and rows[i].get('creator_user_id') != user['id']:
+            return jsonify({'error': '只能使用自己创建的 Agent'}), 403
+    return None
+
+
+OVERLAP_POLICIES = ('skip', 'queue', 'parallel')
+
+
+def _parse_run_limits(data, default_max=1, default_policy='skip'):
+    """解析并发设置：返回 (max_concurrent_runs, overlap_policy, 错误信息)"""
+    try:
+        max_runs = int(data.get('max_concurrent_runs', default_max) or default_max)
+    except (TypeError, ValueError):
+        return None, None, 'max_concurrent_runs 须为正整数'
+    policy = data.get('overlap_policy', default_policy) or default_policy
+    if max_runs < 1:
+        return None, None, 'max_concurrent_runs 须为正整数'
+    if policy not in OVERLAP_POLICIES:
+        return None, None, 'overlap_policy 须为 skip / queue / parallel'
+    return max_runs, policy, None
+
+
 @app.route('/api/data-tasks', methods=['POST'])
 @require_login
 def create_data_task():
@@ -1024,28 +1265,29 @@ def create_data_task():
     task_type = data.get('task_type')
     cron_expr = data.get('cron_expr')
     batch_size = data.get('batch_size', 1)
-    agent_id = data.get('agent_id')
+    agent_id, agent_ids = _normalize_agent_ids(data.get('agent_id'), data.get('agent_ids'))
     template_content = data.get('template_content')
     param_config = data.get('param_config')
     connector_config = data.get('connector_config')
     if not all([name, task_type, cron_expr, agent_id, template_content]):
         return jsonify({'error': '缺少必填项'}), 400
+    max_runs, overlap_policy, limit_err = _parse_run_limits(data)
+    if limit_err:
+        return jsonify({'error': limit_err}), 400
     try:
         with get_db() as conn:
             with conn.cursor() as cur:
-                cur.execute('SELECT id, creator_user_id FROM agents WHERE id = %s', (agent_id,))
-                agent_row = cur.fetchone()
-                if not agent_row:
-                    return jsonify({'error': 'Agent不存在'}), 400
-                if not user.get('is_admin') and agent_row.get('creator_user_id') != user['id']:
-                    return jsonify({'error': '只能使用自己创建的 Agent'}), 403
+                err = _check_task_agents(cur, user, json.loads(agent_ids) if agent_ids else [agent_id])
+                if err:
+                    return err
                 cur.execute('''
-                    INSERT INTO data_tasks (name, task_type, cron_expr, batch_size, agent_id, template_content, param_config, connector_config, creator_user_id, creator_ip)
-                    VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
-                ''', (name, task_type, cron_expr, batch_size, agent_id, template_content,
+                    INSERT INTO data_tasks (name, task_type, cron_expr, batch_size, agent_id, agent_ids, template_content, param_config, connector_config,
+                    max_concurrent_runs, overlap_policy, creator_user_id, creator_ip)
+                    VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
+                ''', (name, task_type, cron_expr, batch_size, agent_id, agent_ids, template_content,
                       json.dumps(param_config) if param_config else None,
                       json.dumps(connector_config) if connector_config else None,
-                      user['id'], client_ip))
+                      max_runs, overlap_policy, user['id'], client_ip))
                 task_id = cur.lastrowid
             conn.commit()
         return jsonify({'success': True, 'data': {'id': task_id}})
@@ -1071,7 +1313,24 @@ def update_data_task(tid):
             name = data.get('name', task['name'])
             cron_expr = data.get('cron_expr', task['cron_expr'])
             batch_size = data.get('batch_size', task['batch_size'])
-            agent_id = data.get('agent_id', task['agent_id'])
+            max_runs, overlap_policy, limit_err = _parse_run_limits(
+                data, task.get('max_concurrent_runs') or 1, task.get('overlap_policy') or 'skip')
+            if limit_err:
+                return jsonify({'error': limit_err}), 400
+            if 'agent_id' in data or 'agent_ids' in data:
+                agent_id, agent_ids = _normalize_agent_ids(
+                    data.get('agent_id', task['agent_id']),
+                    data['agent_ids'] if 'agent_ids' in data else _task_agent_ids(task)[1:]
+                )
+                if not agent_id:
+                    return jsonify({'error': '缺少执行 Agent'}), 400
+                with conn.cursor() as cur:
+                    new_ids = [i for i in (json.loads(agent_ids) if agent_ids else [agent_id]) if i not in _task_agent_ids(task)]
+                    err = _check_task_agents(cur, user, new_ids) if new_ids else None
+                if err:
+                    return err
+            else:
+                agent_id, agent_ids = task['agent_id'], task.get('agent_ids')
             template_content = data.get('template_content', task['template_content'])
             param_config = data.get('param_config', task.get('param_config'))
             connector_config = data.get('connector_config', task.get('connector_config'))
@@ -1095,13 +1354,15 @@ def update_data_task(tid):
                         connector_config['clickhouse']['password'] = old_password if old_password is not None else ''
             with conn.cursor() as cur:
                 cur.execute('''
-                    UPDATE data_tasks SET name=%s, cron_expr=%s, batch_size=%s, agent_id=%s,
-                    template_content=%s, param_config=%s, connector_config=%s WHERE id=%s
-                ''', (name, cron_expr, batch_size, agent_id, template_content,
+                    UPDATE data_tasks SET name=%s, cron_expr=%s, batch_size=%s, agent_id=%s, agent_ids=%s,
+                    template_content=%s, param_config=%s, connector_config=%s, max_concurrent_runs=%s, overlap_policy=%s WHERE id=%s
+                ''', (name, cron_expr, batch_size, agent_id, agent_ids, template_content,
                       json.dumps(param_config) if param_config else param_config,
                       json.dumps(connector_config) if connector_config else connector_config,
-                      tid))
+                      max_runs, overlap_policy, tid))
             conn.commit()
+        invalidate_task_snapshot(task_id=tid)
+        refresh_task_schedule(tid, dict(task, cron_expr=cron_expr, max_concurrent_runs=max_runs, overlap_policy=overlap_policy))
         return jsonify({'success': True})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -1126,6 +1387,8 @@ def delete_data_task(tid):
                 cur.execute('UPDATE data_tasks SET status=%s WHERE id=%s', ('stopped', tid))
                 cur.execute('DELETE FROM data_tasks WHERE id = %s', (tid,))
             conn.commit()
+        invalidate_task_snapshot(task_id=tid)
+        refresh_task_schedule(tid)
         return jsonify({'success': True})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -1136,6 +1399,8 @@ def delete_data_task(tid):
 def start_data_task(tid):
     """启动任务"""
     user = get_current_user()
+    # 先写入缓冲中的执行记录，避免启动前的失败在清零后才计入
+    _try_flush_execution_records()
     try:
         with get_db() as conn:
             with conn.cursor() as cur:
@@ -1146,9 +1411,11 @@ def start_data_task(tid):
             if not can_modify_task(task, user):
                 return jsonify({'error': '无权限操作'}), 403
             with conn.cursor() as cur:
-                cur.execute("UPDATE data_tasks SET status=%s, stop_reason = NULL WHERE id=%s", ('running', tid))
+                cur.execute("UPDATE data_tasks SET status=%s, stop_reason = NULL, consecutive_failures = 0 WHERE id=%s", ('running', tid))
             conn.commit()
         _task_stop_flags[tid] = False
+        invalidate_task_snapshot(task_id=tid)
+        refresh_task_schedule(tid, dict(task, status='running'))
         return jsonify({'success': True})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -1172,6 +1439,8 @@ def stop_data_task(tid):
             with conn.cursor() as cur:
                 cur.execute('UPDATE data_tasks SET status=%s WHERE id=%s', ('stopped', tid))
             conn.commit()
+        invalidate_task_snapshot(task_id=tid)
+        refresh_task_schedule(tid)
         return jsonify({'success': True})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -1180,8 +1449,13 @@ def stop_data_task(tid):
 @app.route('/api/data-tasks/<int:tid>/executions', methods=['GET'])
 @require_login
 def list_task_executions(tid):
-    """任务执行记录"""
+    """任务执行记录，按 id 倒序分页：limit 每页条数，cursor 传上一页返回的 next_cursor（无更多时为 null）"""
     user = get_current_user()
+    try:
+        limit = min(max(int(request.args.get('limit') or EXECUTIONS_PAGE_LIMIT), 1), EXECUTIONS_PAGE_MAX)
+        cursor = int(request.args.get('cursor') or 0)
+    except ValueError:
+        return jsonify({'error': 'limit/cursor 须为整数'}), 400
     try:
         with get_db() as conn:
             with conn.cursor() as cur:
@@ -1193,15 +1467,19 @@ def list_task_executions(tid):
             if not user.get('is_admin') and (cid is None or cid != user['id']):
                 return jsonify({'error': '无权限'}), 403
             with conn.cursor() as cur:
-                cur.execute('SELECT * FROM task_executions WHERE task_id = %s ORDER BY id DESC LIMIT 100', (tid,))
+                if cursor:
+                    cur.execute('SELECT * FROM task_executions WHERE task_id = %s AND id < %s ORDER BY id DESC LIMIT %s', (tid, cursor, limit + 1))
+                else:
+                    cur.execute('SELECT * FROM task_executions WHERE task_id = %s ORDER BY id DESC LIMIT %s', (tid, limit + 1))
                 rows = cur.fetchall()
+        next_cursor = rows[limit - 1]['id'] if len(rows) > limit else None
         result = []
-        for r in rows:
+        for r in rows[:limit]:
             d = dict(r)
             if d.get('executed_at'):
                 d['executed_at'] = d['executed_at'].isoformat()
             result.append(d)
-        return jsonify({'success': True, 'data': result})
+        return jsonify({'success': True, 'data': result, 'next_cursor': next_cursor})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -1211,6 +1489,7 @@ def list_task_executions(tid):
 def clear_task_executions(tid):
     """清空该任务的历史执行记录（仅任务创建者或管理员）"""
     user = get_current_user()
+    _try_flush_execution_records()
     try:
         with get_db() as conn:
             with conn.cursor() as cur:
@@ -1223,64 +1502,258 @@ def clear_task_executions(tid):
                 return jsonify({'error': '无权限'}), 403
             with conn.cursor() as cur:
                 cur.execute('DELETE FROM task_executions WHERE task_id = %s', (tid,))
+                cur.execute('DELETE FROM task_execution_rollups WHERE task_id = %s', (tid,))
         return jsonify({'success': True})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
-def run_task_once(task_id, scheduled_time=None):
-    """执行一次任务并记录结果。scheduled_time 为 cron 计划执行时间，用于渲染模板中的当前时间/时间戳及记录 executed_at。"""
-    batch_no = 1
+@app.route('/api/data-tasks/<int:tid>/execution-rollups', methods=['GET'])
+@require_login
+def list_task_execution_rollups(tid):
+    """已压缩的历史执行汇总（granularity=hour|day，按时间倒序），明细超过保留期后只保留汇总"""
+    user = get_current_user()
+    granularity = request.args.get('granularity') or 'hour'
+    if granularity not in ('hour', 'day'):
+        return jsonify({'error': 'granularity 须为 hour 或 day'}), 400
     try:
         with get_db() as conn:
             with conn.cursor() as cur:
-                cur.execute('SELECT * FROM data_tasks WHERE id = %s AND status = %s', (task_id, 'running'))
-                task = cur.fetchone()
-            if not task or _task_stop_flags.get(task_id):
-                return
+                cur.execute('SELECT creator_user_id FROM data_tasks WHERE id = %s', (tid,))
+                row = cur.fetchone()
+            if not row:
+                return jsonify({'error': '任务不存在'}), 404
+            cid = row.get('creator_user_id')
+            if not user.get('is_admin') and (cid is None or cid != user['id']):
+                return jsonify({'error': '无权限'}), 403
             with conn.cursor() as cur:
-                cur.execute('SELECT url, token FROM agents WHERE id = %s', (task['agent_id'],))
-                agent = cur.fetchone()
-        if not agent:
+                cur.execute(
+                    'SELECT period_start, executions, successes, records_count FROM task_execution_rollups '
+                    'WHERE task_id = %s AND granularity = %s ORDER BY period_start DESC LIMIT %s',
+                    (tid, granularity, EXECUTIONS_PAGE_MAX))
+                rows = cur.fetchall()
+        result = []
+        for r in rows:
+            d = dict(r)
+            d['period_start'] = d['period_start'].isoformat()
+            result.append(d)
+        return jsonify({'success': True, 'data': result})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+def _rows_to_columns(rows):
+    """行转列：[(c1, c2, ...), ...] -> [[c1...], [c2...], ...]"""
+    return [list(col) for col in zip(*rows)]
+
+
+@app.route('/api/data-tasks/<int:tid>/progress', methods=['GET'])
+@require_login
+def get_task_progress(tid):
+    """当前/最近一次执行的分块下发进度（存于 task_progress 表，任一 worker 均可查询）"""
+    user = get_current_user()
+    try:
+        with get_db() as conn:
+            with conn.cursor() as cur:
+                cur.execute('SELECT creator_user_id FROM data_tasks WHERE id = %s', (tid,))
+                row = cur.fetchone()
+                if not row:
+                    return jsonify({'error': '任务不存在'}), 404
+                cid = row.get('creator_user_id')
+                if not user.get('is_admin') and (cid is None or cid != user['id']):
+                    return jsonify({'error': '无权限'}), 403
+                cur.execute('SELECT progress FROM task_progress WHERE task_id = %s', (tid,))
+                prow = cur.fetchone()
+        return jsonify({'success': True, 'data': json.loads(prow['progress']) if prow else None})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+def _parse_connector_config(raw_cc):
+    connector_config = {}
+    if raw_cc:
+        if isinstance(raw_cc, bytes):
+            raw_cc = raw_cc.decode('utf-8', errors='replace')
+        if isinstance(raw_cc, str):
+            try:
+                connector_config = json.loads(raw_cc) or {}
+            except Exception:
+                connector_config = {}
+        elif isinstance(raw_cc, dict):
+            connector_config = raw_cc
+    return connector_config
+
+
+def _load_task_snapshot(task_id):
+    """用一个连接读取任务、Agent 组与 Kafka 证书，解析好 JSON 配置；任务未在运行时返回 None"""
+    with get_db() as conn:
+        with conn.cursor() as cur:
+            cur.execute('SELECT * FROM data_tasks WHERE id = %s AND status = %s', (task_id, 'running'))
+            task = cur.fetchone()
+            if not task:
+                return None
+            agent_ids = _task_agent_ids(task)
+            cur.execute(
+                f'SELECT id, name, url, token, status FROM agents WHERE id IN ({",".join(["%s"] * len(agent_ids))})',
+                agent_ids
+            )
+            found = {r['id']: r for r in cur.fetchall()}
+            param_config = task.get('param_config')
+            if isinstance(param_config, str):
+                param_config = json.loads(param_config) if param_config else []
+            connector_config = _parse_connector_config(task.get('connector_config'))
+            cert = None
+            ssl_cafile_id = (connector_config.get('kafka') or {}).get('ssl_cafile_id') if task['task_type'] == 'kafka' else None
+            if ssl_cafile_id is not None:
+                cur.execute('SELECT content FROM kafka_certs WHERE id = %s', (ssl_cafile_id,))
+                row = cur.fetchone()
+                if row:
+                    cert = row['content']
+    return {
+        'task': task,
+        'agents': [found[i] for i in agent_ids if i in found],
+        'agent_ids': agent_ids,
+        'cert_id': ssl_cafile_id,
+        'param_config': param_config,
+        'connector_config': connector_config,
+        'cert': cert,
+        'loaded_at': time.time(),
+    }
+
+
+def _get_task_snapshot(task_id):
+    """
+    取任务快照（任务定义 + Agent 组 + 证书），命中时不访问数据库。
+    本进程的任务/Agent/证书修改会立即失效对应快照；其他进程的修改由调度器的变更指纹或 TASK_SNAPSHOT_TTL_SECONDS 兜底
+    """
+    with _task_snapshot_lock:
+        snap = _task_snapshots.get(task_id)
+        if snap is not None and time.time() - snap['loaded_at'] < TASK_SNAPSHOT_TTL_SECONDS:
+            return snap
+    snap = _load_task_snapshot(task_id)
+    with _task_snapshot_lock:
+        if snap is None:
+            _task_snapshots.pop(task_id, None)
+        else:
+            _task_snapshots[task_id] = snap
+    return snap
+
+
+def _allocate_batch_no(task_id):
+    """原子地领取本次执行的批次号：data_tasks.next_batch_no 自增，多进程/重叠执行也不会重复；任务已不存在时返回 None"""
+    with get_db() as conn:
+        with conn.cursor() as cur:
+            cur.execute('UPDATE data_tasks SET next_batch_no = LAST_INSERT_ID(next_batch_no + 1) WHERE id = %s', (task_id,))
+            if cur.rowcount != 1:
+                # 未匹配时 LAST_INSERT_ID 是连接上之前语句留下的值，不能使用
+                return None
+            # UPDATE 中的 LAST_INSERT_ID(expr) 会随 OK 包返回，即 cursor.lastrowid
+            return cur.lastrowid - 1
+
+
+def invalidate_task_snapshot(task_id=None, agent_id=None, cert_id=None):
+    """任务/Agent/证书变更后调用：失效相关快照（三者都不传时失效全部），下次执行时重新加载"""
+    everything = task_id is None and agent_id is None and cert_id is None
+    with _task_snapshot_lock:
+        for tid, snap in _task_snapshots.items():
+            if (everything or tid == task_id or (agent_id is not None and agent_id in snap['agent_ids'])
+                    or (cert_id is not None and snap['cert_id'] == cert_id)):
+                snap['loaded_at'] = 0
+
+
+def _task_agent_ids(task):
+    """任务的执行 Agent 列表：主 Agent 在前，其后为 agent_ids 中的其他组成员（去重）"""
+    ids = [task['agent_id']]
+    raw = task.get('agent_ids')
+    if isinstance(raw, str) and raw:
+        try:
+            raw = json.loads(raw)
+        except Exception:
+            raw = None
+    for i in raw or []:
+        if i not in ids:
+            ids.append(i)
+    return ids
+
+
+def _normalize_agent_ids(agent_id, agent_ids):
+    """
+    规范化任务的 Agent 组：返回 (主 agent_id, 写库的 agent_ids JSON 或 None)。
+    agent_ids 为空或只有主 Agent 时不启用分组；未传 agent_id 时取 agent_ids 第一个为主 Agent
+    """
+    ids = []
+    for i in ([agent_id] if agent_id else []) + list(agent_ids or []):
+        try:
+            i = int(i)
+        except (TypeError, ValueError):
+            continue
+        if i not in ids:
+            ids.append(i)
+    if not ids:
+        return None, None
+    return ids[0], (json.dumps(ids) if len(ids) > 1 else None)
+
+
+def run_task_once(task_id, scheduled_time=None):
+    """
+    执行一次任务并记录结果。scheduled_time 为 cron 计划执行时间，用于渲染模板中的当前时间/时间戳及记录 executed_at。
+    消息/SQL 由生成器惰性渲染，按块依次下发到 Agent，内存占用与每批条数无关；每块完成后更新 task_progress 表。
+    """
+    batch_no = 1
+    items_per_record = 1
+    transform = None
+    try:
+        snapshot = _get_task_snapshot(task_id)
+        if not snapshot or _task_stop_flags.get(task_id):
+            return
+        task = snapshot['task']
+        group = snapshot['agents']
+        if not group:
             return
+        # Agent 组：只分配给在线且未熔断的成员；全部不可用时仍交给主 Agent，以便记录失败原因
+        members = [a for a in group
+                   if _agent_status.get(a['id'], a.get('status')) != 'offline' and agent_available(a['url'])] or group[:1]
+        agent = members[0]
+
+        def supports(feature):
+            return all(agent_supports(a['url'], a['token'], feature) for a in members)
+
         task_type = task['task_type']
         template_content = task['template_content']
-        param_config = task.get('param_config')
-        if isinstance(param_config, str):
-            param_config = json.loads(param_config) if param_config else []
-        raw_cc = task.get('connector_config')
-        connector_config = {}
-        if raw_cc:
-            if isinstance(raw_cc, bytes):
-                raw_cc = raw_cc.decode('utf-8', errors='replace')
-            if isinstance(raw_cc, str):
-                try:
-                    connector_config = json.loads(raw_cc) or {}
-                except Exception:
-                    connector_config = {}
-            elif isinstance(raw_cc, dict):
-                connector_config = raw_cc
+        param_config = snapshot['param_config']
+        connector_config = snapshot['connector_config']
         batch_size = task.get('batch_size') or 1
-        with get_db() as conn:
-            with conn.cursor() as cur:
-                cur.execute('SELECT COALESCE(MAX(batch_no),0) + 1 AS nb FROM task_executions WHERE task_id = %s', (task_id,))
-                batch_no = cur.fetchone()['nb'] or 1
+        batch_no = _allocate_batch_no(task_id)
+        if batch_no is None:
+            invalidate_task_snapshot(task_id=task_id)
+            return
+        # Agent 端渲染：只下发模板与参数配置，由 Agent 本地渲染（旧版 Agent 不支持时仍由主程序渲染）
+        # 异步任务：提交到 Agent 后立即返回，由后台轮询/回调写执行记录；异步任务总是由 Agent 端渲染
+        # Agent 组（多个成员）暂不支持异步任务，按同步方式并行下发
+        kind_cfg = connector_config.get(task_type) or {}
+        async_job = len(members) == 1 and bool(kind_cfg.get('async_job')) and supports('jobs')
+        render_on_agent = async_job or (bool(kind_cfg.get('render_on_agent')) and supports('render'))
+        make_items = None  # make_items(start, stop) 惰性渲染本批序号 [start, stop) 的下发条目
         if task_type == 'kafka':
-            messages = render_kafka_messages(template_content, param_config, batch_size, batch_no, reference_time=scheduled_time)
+            # Agent 支持时直接下发预序列化的 JSON 文本（模板形状校验不通过则回退为逐条解析的 dict）；惰性渲染，分块下发
+            if render_on_agent:
+                pass
+            elif (supports('raw_payload')
+                    and kafka_template_is_object(template_content, param_config, batch_no, reference_time=scheduled_time)):
+                def make_items(start, stop):
+                    return iter_kafka_payloads(template_content, param_config, batch_no, start, stop, reference_time=scheduled_time)
+            else:
+                def make_items(start, stop):
+                    return iter_kafka_messages(template_content, param_config, batch_no, start, stop, reference_time=scheduled_time)
+            items_key = 'messages'
+            total_items = batch_size
             conn_cfg = connector_config.get('kafka') or {}
             ssl_cafile = conn_cfg.get('ssl_cafile')
-            ssl_cafile_id = conn_cfg.get('ssl_cafile_id')
-            if ssl_cafile_id is not None:
-                with get_db() as conn:
-                    with conn.cursor() as cur:
-                        cur.execute('SELECT content FROM kafka_certs WHERE id = %s', (ssl_cafile_id,))
-                        row = cur.fetchone()
-                if row:
-                    ssl_cafile = row['content']
+            if snapshot['cert'] is not None:
+                ssl_cafile = snapshot['cert']
             task_data = {
                 'bootstrap_servers': conn_cfg.get('bootstrap_servers', 'localhost:9092'),
                 'topic': conn_cfg.get('topic', ''),
-                'messages': messages,
                 'config': {
                     'security_protocol': conn_cfg.get('security_protocol', 'PLAINTEXT'),
                     'username': conn_cfg.get('username'),
@@ -1290,10 +1763,27 @@ def run_task_once(task_id, scheduled_time=None):
                 }
             }
         else:
-            sqls = render_clickhouse_sqls(
-                json.loads(template_content) if isinstance(template_content, str) and template_content.startswith('[') else template_content,
-                param_config, batch_size, batch_no, reference_time=scheduled_time)
             conn_cfg = connector_config.get('clickhouse') or {}
+            columnar = conn_cfg.get('insert_mode') == 'columnar'
+            if columnar:
+                # 列式写入：模板描述一行，按列生成本批数据，Agent 整批一次 INSERT
+                if not supports('columnar_insert'):
+                    raise RuntimeError('Agent 版本不支持列式写入，请升级 Agent 或改用 SQL 模式')
+                table, columns = parse_columnar_template(template_content)
+                if not render_on_agent:
+                    def make_items(start, stop):
+                        return iter_clickhouse_rows(columns, param_config, batch_no, start, stop, reference_time=scheduled_time)
+                items_key = 'data'
+                transform = _rows_to_columns
+                total_items = batch_size
+            else:
+                template_sqls = json.loads(template_content) if isinstance(template_content, str) and template_content.startswith('[') else template_content
+                if not render_on_agent:
+                    def make_items(start, stop):
+                        return iter_clickhouse_sqls(template_sqls, param_config, batch_no, start, stop, reference_time=scheduled_time)
+                items_key = 'sqls'
+                items_per_record = len(template_sqls) if isinstance(template_sqls, list) and template_sqls else 1
+                total_items = batch_size * items_per_record
             ch_user = conn_cfg.get('user')
             ch_password = conn_cfg.get('password')
             ch_user = (ch_user if ch_user is not None else '') or 'default'
@@ -1305,48 +1795,368 @@ def run_task_once(task_id, scheduled_time=None):
             task_data = {
                 'host': conn_cfg.get('host', 'localhost'),
                 'port': conn_cfg.get('port', 9000),
-                'sqls': sqls,
                 'config': {
                     'user': ch_user.strip() or 'default',
                     'password': ch_password
                 }
             }
-        result = execute_on_agent(agent['url'], agent['token'], task_type, task_data, batch_no)
+            if columnar:
+                task_data['insert'] = {'table': table, 'columns': [name for name, _ in columns]}
+                task_data['use_numpy'] = bool(conn_cfg.get('use_numpy'))
+
+        if render_on_agent:
+            items_per_record = 1
+            total_items = batch_size
+            render_spec = {
+                'template': template_content,
+                'param_config': param_config,
+                'batch_no': batch_no,
+                # 带时区偏移，Agent 与主程序时区不同时 timestamp_10/13 仍一致
+                'reference_time': (scheduled_time if scheduled_time is not None else datetime.now()).astimezone().isoformat(),
+            }
+            if async_job:
+                callback_url = AGENT_CALLBACK_BASE_URL.rstrip('/') + '/api/agent-callbacks/jobs' if AGENT_CALLBACK_BASE_URL else None
+                job_id = submit_job_on_agent(agent['url'], agent['token'], task_type,
+                                             dict(task_data, render=dict(render_spec, start=0, count=batch_size)),
+                                             batch_no, callback_url=callback_url)
+                _save_task_progress(task_id, {'batch_no': batch_no, 'total': batch_size, 'job_id': job_id,
+                                              'status': 'submitted'})
+                _track_agent_job(job_id, task_id, batch_no, agent, batch_size,
+                                 scheduled_time if scheduled_time is not None else datetime.now())
+                return
+
+        # 多个成员时按最近每条耗时加权，把本批序号切成连续区间并行下发（round_robin 等按全局序号渲染，结果与单 Agent 一致）
+        counts = split_by_weight(batch_size, agent_weights([a['url'] for a in members]))
+        shares = []
+        start = 0
+        for a, count in zip(members, counts):
+            if count > 0:
+                shares.append((a, start, count))
+            start += count
+        member_progress = {}
+        progress_lock = threading.Lock()
+
+        def dispatch(share_no, a, start, count):
+            def on_progress(progress):
+                with progress_lock:
+                    member_progress[share_no] = progress
+                    total = {'chunks': sum(p['chunks'] for p in member_progress.values()),
+                             'items': sum(p['items'] for p in member_progress.values())}
+                    # 在锁内写入，多个成员并行时不会用旧的合计覆盖新的
+                    _save_task_progress(task_id, dict(total, batch_no=batch_no, total=total_items, agents=len(shares)))
+
+            on_progress({'chunks': 0, 'items': 0})
+            if render_on_agent:
+                return execute_rendered_on_agent(a['url'], a['token'], task_type, task_data, render_spec, count,
+                                                 batch_no=batch_no, on_progress=on_progress, offset=start)
+            return execute_chunked_on_agent(a['url'], a['token'], task_type, task_data, items_key, make_items(start, start + count),
+                                            batch_no=batch_no, on_progress=on_progress, transform=transform)
+
+        if len(shares) == 1:
+            result = dispatch(0, *shares[0])
+        else:
+            with ThreadPoolExecutor(max_workers=len(shares)) as pool:
+                futures = [pool.submit(dispatch, i, *share) for i, share in enumerate(shares)]
+            results, errors, done_items = [], [], 0
+            for (a, start, count), fut in zip(shares, futures):
+                try:
+                    r = fut.result()
+                    results.append(r)
+                    done_items += r.get('items', 0)
+                except Exception as e:
+                    errors.append(f'Agent {a["name"]}（序号 {start}~{start + count - 1}）: {e}')
+                    if isinstance(e, ChunkedDispatchError):
+                        done_items += e.progress['items']
+            if errors:
+                raise ChunkedDispatchError(
+                    f'{len(errors)}/{len(shares)} 个 Agent 执行失败（已完成 {done_items} 条）:\n' + '\n'.join(errors),
+                    {'chunks': sum(r.get('chunks', 0) for r in results), 'items': done_items}
+                )
+            result = merge_results(results)
+            result['agents'] = {a['name']: count for a, _, count in shares}
         executed_at_val = scheduled_time if scheduled_time is not None else datetime.now()
-        with get_db() as conn:
-            with conn.cursor() as cur:
-                cur.execute(
-                    'INSERT INTO task_executions (task_id, batch_no, success, result_message, records_count, executed_at) VALUES (%s,%s,%s,%s,%s,%s)',
-                    (task_id, batch_no, 1, json.dumps(result), batch_size, executed_at_val))
-            conn.commit()
+        _record_task_execution(task_id, batch_no, True, json.dumps(result), batch_size, executed_at_val)
     except Exception as e:
         err_msg = traceback.format_exc()
         executed_at_val = scheduled_time if scheduled_time is not None else datetime.now()
+        sent_records = e.progress['items'] // items_per_record if isinstance(e, ChunkedDispatchError) else 0
         try:
-            with get_db() as conn:
-                with conn.cursor() as cur:
-                    cur.execute(
-                        'INSERT INTO task_executions (task_id, batch_no, success, result_message, executed_at) VALUES (%s,%s,%s,%s,%s)',
-                        (task_id, batch_no, 0, err_msg, executed_at_val))
-                    cur.execute(
-                        'SELECT success FROM task_executions WHERE task_id = %s ORDER BY id DESC LIMIT 3',
-                        (task_id,)
-                    )
-                    rows = cur.fetchall()
-                    if len(rows) >= 3 and all(r.get('success') == 0 for r in rows):
-                        cur.execute(
-                            "UPDATE data_tasks SET status = 'stopped', stop_reason = %s WHERE id = %s",
-                            ('连续失败超过3次，已自动停止', task_id)
-                        )
+            _record_task_execution(task_id, batch_no, False, err_msg, sent_records, executed_at_val)
         except Exception:
             pass
 
 
-def _run_task_at_scheduled_time(task_id, scheduled_time, schedule_key):
-    """在计划时间到达时执行任务，实现毫秒级准时。schedule_key 为按秒取整的 timestamp，用于去重。"""
-    delay = (scheduled_time - datetime.now()).total_seconds()
-    if delay > 0:
-        time.sleep(delay)
+def _record_task_execution(task_id, batch_no, success, result_message, records_count, executed_at):
+    """登记一条执行记录，由写入线程按 EXECUTION_WRITE_BATCH / EXECUTION_WRITE_INTERVAL 批量写入并更新连续失败计数"""
+    global _execution_writer
+    with _execution_cond:
+        _execution_buffer.append((task_id, batch_no, 1 if success else 0, result_message, records_count, executed_at))
+        _execution_writer_stats['queued'] += 1
+        full = len(_execution_buffer) > EXECUTION_WRITE_MAX_PENDING
+        if len(_execution_buffer) == 1 or len(_execution_buffer) >= EXECUTION_WRITE_BATCH:
+            _execution_cond.notify()
+        if _execution_writer is None or not _execution_writer.is_alive():
+            _execution_writer = threading.Thread(target=execution_writer_loop, daemon=True)
+            _execution_writer.start()
+    if full:
+        # 缓冲已满：由本线程同步写入；仍写不进（数据库不可用）时才丢弃最早的成功记录
+        _try_flush_execution_records()
+        with _execution_cond:
+            _trim_execution_buffer_locked()
+
+
+def _trim_execution_buffer_locked():
+    """缓冲超过 EXECUTION_WRITE_MAX_PENDING 时丢弃最早的成功记录；失败记录用于连续失败计数与自动停止，始终保留"""
+    overflow = len(_execution_buffer) - EXECUTION_WRITE_MAX_PENDING
+    if overflow <= 0:
+        return
+    kept = []
+    dropped = 0
+    for r in _execution_buffer:
+        if dropped < overflow and r[2]:
+            dropped += 1
+        else:
+            kept.append(r)
+    if dropped:
+        _execution_buffer[:] = kept
+        _execution_writer_stats['dropped'] += dropped
+        app.logger.warning('执行记录缓冲已满（%s），丢弃 %s 条最早的成功执行记录', EXECUTION_WRITE_MAX_PENDING, dropped)
+
+
+def _failure_streaks(outcomes):
+    """按顺序的成功/失败序列 -> (是否有成功, 首次成功前的失败数, 首次成功后的最长连续失败, 末尾连续失败数)"""
+    leading = inner_max = run = 0
+    seen_success = False
+    for ok in outcomes:
+        if ok:
+            seen_success = True
+            run = 0
+        elif seen_success:
+            run += 1
+            inner_max = max(inner_max, run)
+        else:
+            leading += 1
+    return seen_success, leading, inner_max, run if seen_success else leading
+
+
+def _write_execution_records(conn, records):
+    """一个事务内批量插入执行记录并按任务更新连续失败计数；返回可能因此被自动停止的任务 id"""
+    task_ids = sorted({r[0] for r in records})
+    with conn.cursor() as cur:
+        # 执行期间被删除的任务的记录直接丢弃，否则外键失败会让整批记录反复重试。
+        # 随后要 UPDATE 这些行，直接加排他锁：共享锁再升级为排他锁会与并发的批次号分配互相死锁
+        cur.execute('SELECT id FROM data_tasks WHERE id IN (%s) FOR UPDATE' % ','.join(['%s'] * len(task_ids)), task_ids)
+        existing = {r['id'] for r in cur.fetchall()}
+    records = [r for r in records if r[0] in existing]
+    if not records:
+        return []
+    outcomes = {}
+    for r in records:
+        outcomes.setdefault(r[0], []).append(r[2])
+    reset_ids = []
+    failed_ids = []
+    with conn.cursor() as cur:
+        cur.executemany(
+            'INSERT INTO task_executions (task_id, batch_no, success, result_message, records_count, executed_at) VALUES (%s,%s,%s,%s,%s,%s)',
+            records)
+        for task_id, seq in outcomes.items():
+            has_success, leading, inner_max, trailing = _failure_streaks(seq)
+            if not leading and not inner_max:
+                reset_ids.append(task_id)
+                continue
+            failed_ids.append(task_id)
+            # SET 从左到右求值：stop_reason、status 看到的是本批之前的 consecutive_failures，最后再更新计数
+            stop_cond = "status = 'running' AND (consecutive_failures + %s >= %s OR %s >= %s)"
+            cur.execute(
+                'UPDATE data_tasks SET stop_reason = IF(' + stop_cond + ', %s, stop_reason), '
+                'status = IF(' + stop_cond + ", 'stopped', status), "
+                'consecutive_failures = IF(%s, 0, consecutive_failures) + %s WHERE id = %s',
+                (leading, AUTO_STOP_FAILURES, inner_max, AUTO_STOP_FAILURES, f'连续失败超过{AUTO_STOP_FAILURES}次，已自动停止',
+                 leading, AUTO_STOP_FAILURES, inner_max, AUTO_STOP_FAILURES,
+                 1 if has_success else 0, trailing, task_id)
+            )
+        if reset_ids:
+            cur.execute('UPDATE data_tasks SET consecutive_failures = 0 WHERE id IN (%s) AND consecutive_failures <> 0'
+                        % ','.join(['%s'] * len(reset_ids)), reset_ids)
+        stopped = []
+        if failed_ids:
+            cur.execute("SELECT id FROM data_tasks WHERE id IN (%s) AND status <> 'running'" % ','.join(['%s'] * len(failed_ids)), failed_ids)
+            stopped = [r['id'] for r in cur.fetchall()]
+    return stopped
+
+
+def flush_execution_records():
+    """把缓冲中的执行记录写入数据库；写入失败时放回缓冲稍后重试。返回本次写入条数"""
+    with _execution_flush_lock:
+        with _execution_cond:
+            records = _execution_buffer[:]
+            del _execution_buffer[:]
+        if not records:
+            return 0
+        started = time.time()
+        try:
+            with get_db() as conn:
+                stopped = _write_execution_records(conn, records)
+        except Exception as e:
+            with _execution_cond:
+                _execution_buffer[:0] = records
+                _trim_execution_buffer_locked()
+                _execution_writer_stats['errors'] += 1
+                _execution_writer_stats['last_error'] = str(e)
+            raise
+        with _execution_cond:
+            _execution_writer_stats['written'] += len(records)
+            _execution_writer_stats['flushes'] += 1
+            _execution_writer_stats['last_flush_rows'] = len(records)
+            _execution_writer_stats['last_flush_seconds'] = round(time.time() - started, 4)
+    for task_id in stopped:
+        invalidate_task_snapshot(task_id=task_id)
+        refresh_task_schedule(task_id)
+    return len(records)
+
+
+def execution_writer_loop():
+    """后台线程：缓冲达到 EXECUTION_WRITE_BATCH 条或最早一条等待超过 EXECUTION_WRITE_INTERVAL 秒时批量写入"""
+    while True:
+        with _execution_cond:
+            while not _execution_buffer:
+                _execution_cond.wait()
+            if len(_execution_buffer) < EXECUTION_WRITE_BATCH:
+                _execution_cond.wait(EXECUTION_WRITE_INTERVAL)
+        try:
+            flush_execution_records()
+        except Exception:
+            time.sleep(max(EXECUTION_WRITE_INTERVAL, 1))
+
+
+def get_execution_writer_stats():
+    with _execution_cond:
+        data = dict(_execution_writer_stats)
+        data['pending'] = len(_execution_buffer)
+    return data
+
+
+def _try_flush_execution_records():
+    """写入缓冲中的执行记录，失败只记日志（记录留在缓冲中由写入线程重试）"""
+    try:
+        flush_execution_records()
+    except Exception as e:
+        app.logger.warning('写入执行记录失败，稍后重试: %s', e)
+
+
+atexit.register(_try_flush_execution_records)
+
+
+def _track_agent_job(job_id, task_id, batch_no, agent, records_count, executed_at):
+    """登记已提交到 Agent 的异步任务，由后台轮询线程（或 Agent 回调）在完成后写执行记录"""
+    global _agent_job_poller
+    with _pending_agent_jobs_lock:
+        _pending_agent_jobs[job_id] = {
+            'task_id': task_id,
+            'batch_no': batch_no,
+            'url': agent['url'],
+            'token': agent['token'],
+            'records_count': records_count,
+            'executed_at': executed_at,
+            'submitted_at': time.time(),
+        }
+        if _agent_job_poller is None or not _agent_job_poller.is_alive():
+            _agent_job_poller = threading.Thread(target=agent_job_poll_loop, daemon=True)
+            _agent_job_poller.start()
+
+
+def _save_task_progress(task_id, progress, merge=False):
+    """写入任务进度到 task_progress 表（gunicorn 多 worker 共享）；merge=True 时合并到已有进度上。写入失败只记日志，不影响执行"""
+    try:
+        with get_db() as conn:
+            with conn.cursor() as cur:
+                if merge:
+                    cur.execute('SELECT progress FROM task_progress WHERE task_id = %s FOR UPDATE', (task_id,))
+                    row = cur.fetchone()
+                    progress = dict(json.loads(row['progress']) if row else {}, **progress)
+                now = datetime.now()
+                progress = dict(progress, updated_at=now.isoformat())
+                cur.execute(
+                    'INSERT INTO task_progress (task_id, progress, updated_at) VALUES (%s, %s, %s) '
+                    'ON DUPLICATE KEY UPDATE progress = VALUES(progress), updated_at = VALUES(updated_at)',
+                    (task_id, json.dumps(progress, ensure_ascii=False), now))
+            conn.commit()
+    except Exception as e:
+        app.logger.warning('写入任务 %s 进度失败: %s', task_id, e)
+
+
+def _finish_agent_job(job_id, job):
+    """异步任务结束：写执行记录。轮询与回调可能同时到达，只有先取到登记项的一方写入；返回是否由本次写入"""
+    with _pending_agent_jobs_lock:
+        pending = _pending_agent_jobs.pop(job_id, None)
+    if pending is None:
+        return False
+    task_id = pending['task_id']
+    if job and job.get('status') == 'succeeded':
+        _save_task_progress(task_id, {'status': 'succeeded'}, merge=True)
+        result = dict(job.get('result') or {}, job_id=job_id)
+        _record_task_execution(task_id, pending['batch_no'], True, json.dumps(result), pending['records_count'], pending['executed_at'])
+    else:
+        _save_task_progress(task_id, {'status': 'failed'}, merge=True)
+        err = format_job_error(job) if job else 'Agent 上找不到该异步任务（Agent 可能已重启）'
+        _record_task_execution(task_id, pending['batch_no'], False, f'[job {job_id}] {err}', 0, pending['executed_at'])
+    return True
+
+
+def agent_job_poll_loop():
+    """后台线程：轮询已提交到 Agent 的异步任务，结束或超时后写执行记录；无待完成任务时退出"""
+    global _agent_job_poller
+    while True:
+        time.sleep(AGENT_JOB_POLL_INTERVAL)
+        with _pending_agent_jobs_lock:
+            pending = list(_pending_agent_jobs.items())
+            if not pending:
+                # 在锁内登记退出，_track_agent_job 随后登记的任务会启动新的轮询线程
+                if _agent_job_poller is threading.current_thread():
+                    _agent_job_poller = None
+                return
+        for job_id, p in pending:
+            try:
+                try:
+                    job = get_job_on_agent(p['url'], p['token'], job_id)
+                except Exception as e:
+                    job = {'status': 'unknown', 'error': str(e)}
+                if job is None or job.get('status') in ('succeeded', 'failed'):
+                    _finish_agent_job(job_id, job)
+                elif time.time() - p['submitted_at'] > AGENT_JOB_TIMEOUT:
+                    _finish_agent_job(job_id, {
+                        'status': 'failed',
+                        'error': f'异步任务超过 {AGENT_JOB_TIMEOUT} 秒未完成（最后状态: {job.get("status")}，{job.get("error") or ""}）'
+                    })
+            except Exception:
+                pass
+
+
+@app.route('/api/agent-callbacks/jobs', methods=['POST'])
+def agent_job_callback():
+    """Agent 异步任务完成回调（校验 X-Agent-Token 与提交时的 Agent 一致）；非本进程提交的任务由提交方轮询处理"""
+    job = request.get_json() or {}
+    job_id = job.get('job_id')
+    with _pending_agent_jobs_lock:
+        pending = _pending_agent_jobs.get(job_id)
+    if pending is None:
+        return jsonify({'error': 'job not found'}), 404
+    if request.headers.get('X-Agent-Token') != pending['token']:
+        return jsonify({'error': 'Invalid or missing token'}), 401
+    if job.get('status') not in ('succeeded', 'failed'):
+        return jsonify({'error': 'job not finished'}), 400
+    try:
+        _finish_agent_job(job_id, job)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    return jsonify({'success': True})
+
+
+def _execute_scheduled_run(task_id, scheduled_time, schedule_key):
+    """执行线程池中的一次计划执行：执行任务、释放认领，并把该任务排队中的下一次执行提交到线程池"""
+    with _run_lock:
+        _run_stats['waiting'] -= 1
+        _run_stats['active'] += 1
     try:
         run_task_once(task_id, scheduled_time=scheduled_time)
     finally:
@@ -1362,17 +2172,353 @@ def _run_task_at_scheduled_time(task_id, scheduled_time, schedule_key):
         with _scheduled_run_lock:
             if _scheduled_run_at.get(task_id) == schedule_key:
                 _scheduled_run_at.pop(task_id, None)
+        with _run_lock:
+            _run_stats['active'] -= 1
+            _run_stats['completed'] += 1
+            slot = _task_runs.get(task_id)
+            nxt = None
+            if slot:
+                slot['inflight'] -= 1
+                if slot['backlog']:
+                    nxt = slot['backlog'].popleft()
+                    _run_stats['backlog'] -= 1
+                    slot['inflight'] += 1
+                elif slot['inflight'] <= 0:
+                    _task_runs.pop(task_id, None)
+            if nxt:
+                _submit_run_locked(task_id, *nxt)
+
+
+def _submit_run_locked(task_id, scheduled_time, schedule_key):
+    """在持有 _run_lock 时调用：提交到执行线程池（线程数固定为 TASK_RUN_WORKERS，超出的排在线程池队列中）"""
+    global _run_executor
+    if _run_executor is None:
+        _run_executor = ThreadPoolExecutor(max_workers=TASK_RUN_WORKERS, thread_name_prefix='task-run')
+    _run_stats['waiting'] += 1
+    _run_stats['submitted'] += 1
+    _run_executor.submit(_execute_scheduled_run, task_id, scheduled_time, schedule_key)
+
+
+def _dispatch_run(task_id, scheduled_time, schedule_key, max_runs, policy):
+    """
+    到点后按任务的并发设置分发一次执行：该任务在途执行数未达 max_concurrent_runs 时直接提交；
+    达到上限时按 overlap_policy 处理：skip 跳过本次，queue 排队等前一次结束（最多 TASK_RUN_BACKLOG_LIMIT 个），parallel 不受上限约束
+    """
+    with _run_lock:
+        slot = _task_runs.setdefault(task_id, {'inflight': 0, 'backlog': deque()})
+        if slot['inflight'] < max_runs or policy == 'parallel':
+            slot['inflight'] += 1
+            _submit_run_locked(task_id, scheduled_time, schedule_key)
+            return True
+        if policy == 'queue' and len(slot['backlog']) < TASK_RUN_BACKLOG_LIMIT:
+            slot['backlog'].append((scheduled_time, schedule_key))
+            _run_stats['backlog'] += 1
+            return True
+        _run_stats['skipped'] += 1
+    # 跳过的计划执行保留认领记录，其他实例也不会再执行这一次
+    with _scheduled_run_lock:
+        if _scheduled_run_at.get(task_id) == schedule_key:
+            _scheduled_run_at.pop(task_id, None)
+    return False
+
+
+def _next_fire(entry, after):
+    """用该任务缓存的 croniter 取 after 之后的下一次触发时间（cron 未变时不重建 croniter）"""
+    entry['iter'].set_current(after)
+    return entry['iter'].get_next(datetime)
+
+
+def _push_schedule_locked(task_id, entry, after):
+    """在持有 _sched_cond 时调用：计算下次触发时间并入堆（旧的堆项按 version 作废）"""
+    entry['version'] += 1
+    entry['next_run'] = _next_fire(entry, after)
+    heapq.heappush(_sched_heap, (entry['next_run'].timestamp(), task_id, entry['version']))
+
+
+def refresh_task_schedule(task_id, task=None):
+    """
+    任务创建/修改/启停/删除后调用：task（含 status、cron_expr、max_concurrent_runs、overlap_policy）为 running 时
+    重新计算下次触发时间，否则（含 task 为 None）移出调度队列
+    """
+    if not _scheduler_active.is_set():
+        return  # 非调度主节点不维护调度队列，变更由主节点经变更指纹/对账发现
+    task = task or {}
+    cron_expr = task.get('cron_expr')
+    normalized = (_normalize_cron_to_croniter(cron_expr)
+                  if task.get('status') == 'running' and cron_expr and _owns_task(task_id) else None)
+    with _sched_cond:
+        if not normalized:
+            _sched_entries.pop(task_id, None)
+        else:
+            entry = _sched_entries.get(task_id)
+            if entry is None or entry['cron'] != normalized:
+                try:
+                    it = croniter(normalized, datetime.now())
+                except Exception:
+                    _sched_entries.pop(task_id, None)
+                    _sched_cond.notify()
+                    return
+                entry = _sched_entries[task_id] = {'cron': normalized, 'iter': it, 'version': 0, 'next_run': None}
+                _push_schedule_locked(task_id, entry, datetime.now())
+            entry['max_runs'] = max(1, int(task.get('max_concurrent_runs') or 1))
+            entry['policy'] = task.get('overlap_policy') or 'skip'
+        _sched_cond.notify()
+
+
+def _reconcile_schedule():
+    """与数据库对账：补上其他实例启动/修改的任务，移除已停止或已删除的任务"""
+    started = time.time()
+    with get_db() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                'SELECT id, status, cron_expr, max_concurrent_runs, overlap_policy FROM data_tasks WHERE status = %s',
+                ('running',)
+            )
+            rows = cur.fetchall()
+    running = {r['id']: r for r in rows}
+    with _sched_cond:
+        stale = [tid for tid in _sched_entries if tid not in running]
+    for tid in stale:
+        refresh_task_schedule(tid)
+    for tid, row in running.items():
+        refresh_task_schedule(tid, row)
+    with _sched_cond:
+        _scheduler_stats.update({
+            'reconciles': _scheduler_stats['reconciles'] + 1,
+            'last_reconcile_at': datetime.now().isoformat(),
+            'last_reconcile_seconds': round(time.time() - started, 3),
+        })
+
+
+def _task_table_fingerprint():
+    """
+    data_tasks 的变更指纹（任务数、最大 id、最近修改时间），用于发现其他进程对任务的修改。
+    MAX(id)/MAX(updated_at) 走主键与 idx_updated_at 只读索引端点，COUNT(*) 走最小的二级索引
+    """
+    with get_db() as conn:
+        with conn.cursor() as cur:
+            cur.execute('SELECT COUNT(*) AS n, MAX(id) AS max_id, MAX(updated_at) AS updated FROM data_tasks')
+            row = cur.fetchone()
+    return row['n'], row['max_id'], row['updated']
+
+
+def _claim_run(task_id, next_run):
+    """认领本次计划执行（data_task_schedule_claims 去重，多实例只执行一次）；返回 schedule_key，未认领到时返回 None"""
+    schedule_key = int(round(next_run.timestamp(), 0))
+    with _scheduled_run_lock:
+        if _scheduled_run_at.get(task_id) == schedule_key:
+            return None
+        _scheduled_run_at[task_id] = schedule_key
+    try:
+        with get_db() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    'INSERT INTO data_task_schedule_claims (task_id, schedule_key_ts) VALUES (%s, %s)',
+                    (task_id, schedule_key)
+                )
+    except Exception:
+        with _scheduled_run_lock:
+            if _scheduled_run_at.get(task_id) == schedule_key:
+                _scheduled_run_at.pop(task_id, None)
+        return None
+    return schedule_key
+
+
+def _release_launch_queue():
+    """失去调度权时调用：丢弃已认领但未到点的执行，并删除其认领记录，让新的主节点可以重新认领"""
+    with _sched_cond:
+        released = [(task_id, schedule_key) for _, task_id, _, schedule_key in _launch_heap]
+        del _launch_heap[:]
+    if not released:
+        return
+    with _scheduled_run_lock:
+        for task_id, schedule_key in released:
+            if _scheduled_run_at.get(task_id) == schedule_key:
+                _scheduled_run_at.pop(task_id, None)
+    try:
+        with get_db() as conn:
+            with conn.cursor() as cur:
+                cur.executemany('DELETE FROM data_task_schedule_claims WHERE task_id = %s AND schedule_key_ts = %s', released)
+    except Exception:
+        pass
+
+
+class _HashRing:
+    """一致性哈希环：每个节点放 SCHEDULER_VNODES 个虚拟节点，节点增减时只有相邻区间的任务换节点"""
+
+    def __init__(self, nodes, vnodes):
+        points = []
+        for node in nodes:
+            for i in range(vnodes):
+                points.append((self._hash(f'{node}#{i}'), node))
+        points.sort()
+        self._keys = [p[0] for p in points]
+        self._nodes = [p[1] for p in points]
+
+    @staticmethod
+    def _hash(key):
+        return int(hashlib.md5(str(key).encode('utf-8')).hexdigest()[:16], 16)
+
+    def owner(self, key):
+        if not self._keys:
+            return None
+        i = bisect.bisect(self._keys, self._hash(key)) % len(self._keys)
+        return self._nodes[i]
+
+
+def _owns_task(task_id):
+    """sharded 模式下该任务是否归本节点调度（环尚未建立时不调度任何任务）；其他模式始终为 True"""
+    if SCHEDULER_MODE != 'sharded':
+        return True
+    ring = _shard_ring
+    return ring is not None and ring.owner(task_id) == _scheduler_node
+
+
+def _unregister_scheduler_node():
+    """进程退出时注销节点，其他节点下一次心跳即接管其任务"""
+    try:
+        with get_db() as conn:
+            with conn.cursor() as cur:
+                cur.execute('DELETE FROM scheduler_nodes WHERE node_id = %s', (_scheduler_node,))
+    except Exception:
+        pass
+
+
+def scheduler_membership_loop():
+    """
+    sharded 模式的成员线程：每 SCHEDULER_LEADER_HEARTBEAT_SECONDS 秒在 scheduler_nodes 写心跳并读取存活节点，
+    节点加入/离开（心跳超过 SCHEDULER_NODE_TIMEOUT_SECONDS）时重建哈希环并立即对账，重新划分本节点负责的任务
+    """
+    global _shard_ring, _shard_nodes
+    host, _, pid = _scheduler_node.rpartition(':')
+    while True:
+        try:
+            with get_db() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        'INSERT INTO scheduler_nodes (node_id, host, pid, started_at, heartbeat_at) VALUES (%s, %s, %s, NOW(), NOW()) '
+                        'ON DUPLICATE KEY UPDATE heartbeat_at = NOW()',
+                        (_scheduler_node, host, int(pid))
+                    )
+                    cur.execute(
+                        'SELECT node_id FROM scheduler_nodes WHERE heartbeat_at >= NOW() - INTERVAL %s SECOND ORDER BY node_id',
+                        (SCHEDULER_NODE_TIMEOUT_SECONDS,)
+                    )
+                    nodes = tuple(r['node_id'] for r in cur.fetchall())
+                    cur.execute(
+                        'DELETE FROM scheduler_nodes WHERE heartbeat_at < NOW() - INTERVAL %s SECOND',
+                        (SCHEDULER_NODE_TIMEOUT_SECONDS * 30,)
+                    )
+            if nodes != _shard_nodes:
+                _shard_ring = _HashRing(nodes, SCHEDULER_VNODES)
+                _shard_nodes = nodes
+                with _sched_cond:
+                    _scheduler_stats['rebalances'] += 1
+                    _sched_force_reconcile.set()
+                    _sched_cond.notify()
+        except Exception as e:
+            with _sched_cond:
+                _scheduler_stats['last_error'] = str(e)
+        time.sleep(SCHEDULER_LEADER_HEARTBEAT_SECONDS)
+
+
+def _release_leadership():
+    global _leader_conn
+    conn, _leader_conn = _leader_conn, None
+    if conn is not None:
+        try:
+            conn.close()  # 连接断开即释放 GET_LOCK
+        except Exception:
+            pass
+    if _scheduler_active.is_set():
+        _scheduler_active.clear()
+        with _sched_cond:
+            _scheduler_stats.update(is_leader=False, leader_since=None)
+            _sched_cond.notify()
+
+
+def scheduler_leader_loop():
+    """
+    选主线程：用独立 MySQL 连接持有 GET_LOCK(SCHEDULER_LOCK_NAME)，持锁的进程为调度主节点。
+    主节点每 SCHEDULER_LEADER_HEARTBEAT_SECONDS 秒确认锁仍归本连接；备节点按同一间隔尝试抢锁。
+    主进程退出时连接断开、锁立即释放；主机宕机时由 wait_timeout 兜底，故障切换在数秒内完成
+    """
+    global _leader_conn
+    while True:
+        try:
+            if _leader_conn is None:
+                conn = get_connection()
+                try:
+                    with conn.cursor() as cur:
+                        cur.execute('SET SESSION wait_timeout = %s', (SCHEDULER_LEADER_TIMEOUT_SECONDS,))
+                        cur.execute('SELECT GET_LOCK(%s, 0) AS got', (SCHEDULER_LOCK_NAME,))
+                        got = cur.fetchone()['got'] == 1
+                except Exception:
+                    conn.close()
+                    raise
+                if got:
+                    _leader_conn = conn
+                    with _sched_cond:
+                        _scheduler_stats.update(is_leader=True, leader_since=datetime.now().isoformat(),
+                                                leader_changes=_scheduler_stats['leader_changes'] + 1)
+                    _scheduler_active.set()
+                else:
+                    conn.close()
+            else:
+                with _leader_conn.cursor() as cur:
+                    cur.execute('SELECT IS_USED_LOCK(%s) = CONNECTION_ID() AS mine', (SCHEDULER_LOCK_NAME,))
+                    if cur.fetchone()['mine'] != 1:
+                        _release_leadership()
+        except Exception:
+            _release_leadership()
+        time.sleep(SCHEDULER_LEADER_HEARTBEAT_SECONDS)
 
 
 def scheduler_loop():
-    """调度循环：按Cron执行运行中的任务；临近计划时间时起线程 sleep 到点再执行，实现毫秒级准时"""
-    from croniter import croniter
-    loop_count = 0
+    """
+    调度循环（单线程兼作定时器，仅在调度主节点上工作）：内存最小堆保存各运行中任务的下次触发时间，提前 SCHEDULER_LEAD_SECONDS 认领，
+    认领成功的放入待触发堆，到点（毫秒级）后交给执行线程池；本进程的任务变更由 refresh_task_schedule 唤醒，
+    其他进程的变更由变更指纹发现，另每 SCHEDULER_RECONCILE_SECONDS 秒与数据库对账一次
+    """
+    next_reconcile = 0
+    next_claims_cleanup = time.time() + 300
+    next_change_poll = 0
+    last_fingerprint = None
     while True:
         try:
-            loop_count += 1
-            if loop_count >= 300:
-                loop_count = 0
+            if not _scheduler_active.is_set():
+                # 备节点：清空本地调度队列与已认领待触发的执行，等待成为主节点后按数据库重新对账
+                with _sched_cond:
+                    _sched_entries.clear()
+                    del _sched_heap[:]
+                _release_launch_queue()
+                _scheduler_active.wait()
+                next_reconcile = 0
+            now = time.time()
+            if _sched_force_reconcile.is_set():
+                _sched_force_reconcile.clear()
+                next_reconcile = now
+            if now >= next_change_poll:
+                # 其他进程修改/启停任务只写数据库：轻量查询 data_tasks 的变更指纹，有变化时立即对账
+                next_change_poll = now + SCHEDULER_CHANGE_POLL_SECONDS
+                try:
+                    fingerprint = _task_table_fingerprint()
+                    if fingerprint != last_fingerprint:
+                        if last_fingerprint is not None:
+                            next_reconcile = now
+                            invalidate_task_snapshot()
+                        last_fingerprint = fingerprint
+                except Exception:
+                    pass
+            if now >= next_reconcile:
+                try:
+                    _reconcile_schedule()
+                except Exception as e:
+                    with _sched_cond:
+                        _scheduler_stats['last_error'] = str(e)
+                next_reconcile = time.time() + SCHEDULER_RECONCILE_SECONDS
+            if now >= next_claims_cleanup:
+                next_claims_cleanup = now + 300
                 try:
                     with get_db() as conn:
                         with conn.cursor() as cur:
@@ -1382,85 +2528,135 @@ def scheduler_loop():
                             )
                 except Exception:
                     pass
-            with get_db() as conn:
-                with conn.cursor() as cur:
-                    cur.execute('SELECT id, cron_expr FROM data_tasks WHERE status = %s', ('running',))
-                    tasks = cur.fetchall()
-            now = datetime.now()
-            for t in tasks:
-                if _task_stop_flags.get(t['id']):
-                    continue
-                try:
-                    normalized = _normalize_cron_to_croniter(t['cron_expr'])
-                    if not normalized:
-                        continue
-                    cron = croniter(normalized, now)
-                    next_run = cron.get_next(datetime)
-                    secs = (next_run - now).total_seconds()
-                    if secs <= 0 or secs > 65:
+            due = []
+            fire = []
+            with _sched_cond:
+                now = time.time()
+                while _sched_heap and _sched_heap[0][0] - SCHEDULER_LEAD_SECONDS <= now:
+                    fire_ts, task_id, version = heapq.heappop(_sched_heap)
+                    entry = _sched_entries.get(task_id)
+                    if entry is None or entry['version'] != version:
                         continue
-                    schedule_key = int(round(next_run.timestamp(), 0))
-                    with _scheduled_run_lock:
-                        if _scheduled_run_at.get(t['id']) == schedule_key:
-                            continue
-                        _scheduled_run_at[t['id']] = schedule_key
-                    try:
-                        with get_db() as conn:
-                            with conn.cursor() as cur:
-                                cur.execute(
-                                    'INSERT INTO data_task_schedule_claims (task_id, schedule_key_ts) VALUES (%s, %s)',
-                                    (t['id'], schedule_key)
-                                )
-                    except IntegrityError:
-                        with _scheduled_run_lock:
-                            if _scheduled_run_at.get(t['id']) == schedule_key:
-                                _scheduled_run_at.pop(t['id'], None)
+                    fire_at = entry['next_run']
+                    _push_schedule_locked(task_id, entry, fire_at)
+                    # 调度线程被长时间阻塞（如数据库卡顿）时跳过已错过的触发，与原逐秒扫描的行为一致
+                    if now - fire_ts <= SCHEDULER_MISFIRE_GRACE_SECONDS:
+                        due.append((task_id, fire_at))
+                    else:
+                        _scheduler_stats['misfires'] += 1
+                while _launch_heap and _launch_heap[0][0] <= now:
+                    fire.append(heapq.heappop(_launch_heap))
+                if not due and not fire:
+                    if not _scheduler_active.is_set():
                         continue
-                    threading.Thread(
-                        target=_run_task_at_scheduled_time,
-                        args=(t['id'], next_run, schedule_key),
-                        daemon=True
-                    ).start()
-                except Exception:
-                    pass
+                    wait = min(next_reconcile, next_claims_cleanup, next_change_poll) - now
+                    if _sched_heap:
+                        wait = min(wait, _sched_heap[0][0] - SCHEDULER_LEAD_SECONDS - now)
+                    if _launch_heap:
+                        wait = min(wait, _launch_heap[0][0] - now)
+                    if wait > 0:
+                        _sched_cond.wait(wait)
+                    continue
+                _scheduler_stats['fired'] += len(due)
+            for task_id, fire_at in due:
+                if _task_stop_flags.get(task_id):
+                    continue
+                schedule_key = _claim_run(task_id, fire_at)
+                if schedule_key is not None:
+                    with _sched_cond:
+                        heapq.heappush(_launch_heap, (fire_at.timestamp(), task_id, fire_at, schedule_key))
+            for _, task_id, fire_at, schedule_key in fire:
+                with _sched_cond:
+                    entry = _sched_entries.get(task_id) or {}
+                _dispatch_run(task_id, fire_at, schedule_key, entry.get('max_runs', 1), entry.get('policy', 'skip'))
         except Exception:
-            pass
-        time.sleep(1)
+            time.sleep(1)
+
+
+def get_scheduler_stats():
+    """调度器与执行线程池状态（供运行指标展示）"""
+    with _sched_cond:
+        upcoming = min((e['next_run'] for e in _sched_entries.values()), default=None)
+        stats = dict(_scheduler_stats, mode=SCHEDULER_MODE, node=_scheduler_node, shard_nodes=list(_shard_nodes), tasks=len(_sched_entries), heap_size=len(_sched_heap),
+                     pending_launch=len(_launch_heap), next_fire_at=upcoming.isoformat() if upcoming else None)
+    with _run_lock:
+        runs = dict(_run_stats, workers=TASK_RUN_WORKERS)
+    runs['saturation'] = round(runs['active'] / TASK_RUN_WORKERS, 3)
+    stats['runs'] = runs
+    return stats
 
 
 def start_scheduler():
-    global _task_scheduler
+    global _task_scheduler, _leader_thread
+    if SCHEDULER_MODE in ('leader', 'sharded'):
+        if _leader_thread is None or not _leader_thread.is_alive():
+            if SCHEDULER_MODE == 'sharded':
+                _scheduler_active.set()
+                atexit.register(_unregister_scheduler_node)
+            target = scheduler_leader_loop if SCHEDULER_MODE == 'leader' else scheduler_membership_loop
+            _leader_thread = threading.Thread(target=target, daemon=True)
+            _leader_thread.start()
+    else:
+        _scheduler_active.set()
     if _task_scheduler is None or not _task_scheduler.is_alive():
         _task_scheduler = threading.Thread(target=scheduler_loop, daemon=True)
         _task_scheduler.start()
 
 
+def _probe_agent_status(row):
+    try:
+        ok, _ = check_agent(row['url'], row['token'])
+        return 'online' if ok else 'offline'
+    except Exception:
+        return 'offline'
+
+
+def refresh_all_agents_status():
+    """并发探测所有 Agent（线程数上限 AGENT_PROBE_WORKERS），结果一条 UPDATE 批量写回，并记录本轮耗时"""
+    started = time.time()
+    with get_db() as conn:
+        with conn.cursor() as cur:
+            cur.execute('SELECT id, url, token FROM agents')
+            rows = cur.fetchall()
+    if rows:
+        with ThreadPoolExecutor(max_workers=min(AGENT_PROBE_WORKERS, len(rows))) as pool:
+            statuses = list(pool.map(_probe_agent_status, rows))
+        case_sql = ' '.join(['WHEN %s THEN %s'] * len(rows))
+        params = []
+        for r, status in zip(rows, statuses):
+            params.extend([r['id'], status])
+            _agent_status[r['id']] = status
+        params.extend(r['id'] for r in rows)
+        with get_db() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    f'UPDATE agents SET status = CASE id {case_sql} END, last_check_at = NOW() '
+                    f'WHERE id IN ({",".join(["%s"] * len(rows))})',
+                    params
+                )
+    else:
+        statuses = []
+    elapsed = time.time() - started
+    with _agent_refresh_stats_lock:
+        _agent_refresh_stats.update({
+            'cycles': _agent_refresh_stats['cycles'] + 1,
+            'last_cycle_seconds': round(elapsed, 3),
+            'max_cycle_seconds': round(max(_agent_refresh_stats['max_cycle_seconds'] or 0, elapsed), 3),
+            'last_cycle_at': datetime.now().isoformat(),
+            'agents': len(rows),
+            'online': statuses.count('online'),
+        })
+
+
 def refresh_all_agents_status_loop():
     """后台线程：每分钟刷新所有 Agent 的在线状态"""
     while True:
         try:
             time.sleep(60)
-            with get_db() as conn:
-                with conn.cursor() as cur:
-                    cur.execute('SELECT id, url, token FROM agents')
-                    rows = cur.fetchall()
-            for r in rows:
-                try:
-                    ok, _ = check_agent(r['url'], r['token'])
-                    status = 'online' if ok else 'offline'
-                except Exception:
-                    status = 'offline'
-                try:
-                    with get_db() as conn:
-                        with conn.cursor() as cur:
-                            cur.execute(
-                                'UPDATE agents SET status = %s, last_check_at = NOW() WHERE id = %s',
-                                (status, r['id'])
-                            )
-                except Exception:
-                    pass
-        except Exception:
-            pass
+            refresh_all_agents_status()
+        except Exception as e:
+            with _agent_refresh_stats_lock:
+                _agent_refresh_stats['last_error'] = str(e)
 
 
 def start_agent_status_refresh():
@@ -1471,6 +2667,139 @@ def start_agent_status_refresh():
         _agent_status_thread.start()
 
 
+def _compact_raw_executions(conn, cutoff):
+    """把 cutoff 之前的执行记录明细按 (任务, 小时) 累加进汇总表后删除，按 id 分段各自提交；返回删除的明细条数"""
+    with conn.cursor() as cur:
+        cur.execute('SELECT MIN(id) AS lo FROM task_executions')
+        lo = cur.fetchone()['lo']
+        cur.execute('SELECT MAX(id) AS hi FROM task_executions WHERE executed_at < %s', (cutoff,))
+        hi = cur.fetchone()['hi']
+    conn.commit()
+    if lo is None or hi is None:
+        return 0
+    compacted = 0
+    while lo <= hi:
+        up = min(lo + EXECUTION_RETENTION_BATCH - 1, hi)
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                INSERT INTO task_execution_rollups (task_id, granularity, period_start, executions, successes, records_count)
+                SELECT task_id, 'hour', DATE_FORMAT(executed_at, '%%Y-%%m-%%d %%H:00:00'), COUNT(*), SUM(success), SUM(records_count)
+                FROM task_executions WHERE id BETWEEN %s AND %s AND executed_at < %s
+                GROUP BY task_id, DATE_FORMAT(executed_at, '%%Y-%%m-%%d %%H:00:00')
+                ON DUPLICATE KEY UPDATE executions = executions + VALUES(executions),
+                    successes = successes + VALUES(successes), records_count = records_count + VALUES(records_count)
+                """,
+                (lo, up, cutoff)
+            )
+            cur.execute('DELETE FROM task_executions WHERE id BETWEEN %s AND %s AND executed_at < %s', (lo, up, cutoff))
+            compacted += cur.rowcount
+        conn.commit()
+        lo = up + 1
+    return compacted
+
+
+def _merge_hourly_rollups(conn, cutoff):
+    """把 cutoff 之前的按小时汇总合并为按天汇总；返回删除的小时汇总条数"""
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            INSERT INTO task_execution_rollups (task_id, granularity, period_start, executions, successes, records_count)
+            SELECT task_id, 'day', DATE(period_start), SUM(executions), SUM(successes), SUM(records_count)
+            FROM task_execution_rollups WHERE granularity = 'hour' AND period_start < %s
+            GROUP BY task_id, DATE(period_start)
+            ON DUPLICATE KEY UPDATE executions = executions + VALUES(executions),
+                successes = successes + VALUES(successes), records_count = records_count + VALUES(records_count)
+            """,
+            (cutoff,)
+        )
+        cur.execute("DELETE FROM task_execution_rollups WHERE granularity = 'hour' AND period_start < %s", (cutoff,))
+        merged = cur.rowcount
+    conn.commit()
+    return merged
+
+
+def compact_task_executions():
+    """执行记录保留策略：明细超过 EXECUTION_RETENTION_DAYS 天压缩为小时汇总，小时汇总超过 EXECUTION_HOURLY_RETENTION_DAYS 天合并为天汇总。
+    多进程时通过 MySQL GET_LOCK 保证同一时间只有一个进程在压缩；未拿到锁返回 None"""
+    started = time.time()
+    now = datetime.now()
+    # 锁在独立连接上持有，结束后直接关闭连接释放锁，避免带锁的连接回到连接池
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute('SELECT GET_LOCK(%s, 0) AS ok', (EXECUTION_RETENTION_LOCK_NAME,))
+            if not cur.fetchone()['ok']:
+                return None
+        compacted = merged = 0
+        if EXECUTION_RETENTION_DAYS > 0:
+            cutoff = (now - timedelta(days=EXECUTION_RETENTION_DAYS)).replace(minute=0, second=0, microsecond=0)
+            compacted = _compact_raw_executions(conn, cutoff)
+        if EXECUTION_HOURLY_RETENTION_DAYS > 0:
+            cutoff = (now - timedelta(days=EXECUTION_HOURLY_RETENTION_DAYS)).replace(hour=0, minute=0, second=0, microsecond=0)
+            merged = _merge_hourly_rollups(conn, cutoff)
+    except Exception:
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+        raise
+    finally:
+        conn.close()
+    with _retention_stats_lock:
+        _retention_stats['runs'] += 1
+        _retention_stats['last_run_at'] = now.isoformat()
+        _retention_stats['last_run_seconds'] = round(time.time() - started, 3)
+        _retention_stats['compacted'] += compacted
+        _retention_stats['hourly_merged'] += merged
+        _retention_stats['last_error'] = None
+    return {'compacted': compacted, 'hourly_merged': merged}
+
+
+def execution_retention_loop():
+    """后台线程：每 EXECUTION_RETENTION_INTERVAL_SECONDS 秒压缩一次历史执行记录"""
+    while True:
+        try:
+            time.sleep(EXECUTION_RETENTION_INTERVAL_SECONDS)
+            compact_task_executions()
+        except Exception as e:
+            with _retention_stats_lock:
+                _retention_stats['last_error'] = str(e)
+
+
+def start_execution_retention():
+    """启动执行记录压缩线程（EXECUTION_RETENTION_DAYS 大于 0 时）"""
+    global _retention_thread
+    if EXECUTION_RETENTION_DAYS <= 0:
+        return
+    if _retention_thread is None or not _retention_thread.is_alive():
+        _retention_thread = threading.Thread(target=execution_retention_loop, daemon=True)
+        _retention_thread.start()
+
+
+# ---------- 运行指标 ----------
+@app.route('/api/metrics', methods=['GET'])
+@require_login
+def get_metrics():
+    """后台线程运行指标（仅管理员）"""
+    user = get_current_user()
+    if not user.get('is_admin'):
+        return jsonify({'error': '无权限'}), 403
+    with _agent_refresh_stats_lock:
+        agent_refresh = dict(_agent_refresh_stats)
+    with _retention_stats_lock:
+        retention = dict(_retention_stats)
+    return jsonify({'success': True, 'data': {
+        'agent_refresh': agent_refresh,
+        'agent_breakers': get_breaker_states(),
+        'agent_sessions': get_session_stats(),
+        'scheduler': get_scheduler_stats(),
+        'db_pool': get_pool_stats(),
+        'execution_retention': retention,
+        'execution_writer': get_execution_writer_stats(),
+    }})
+
+
 # ---------- Kafka 证书管理 ----------
 @app.route('/api/kafka-certs', methods=['GET'])
 @require_login
@@ -1533,6 +2862,7 @@ def delete_kafka_cert(cid):
                 if cur.rowcount == 0:
                     return jsonify({'error': '证书不存在'}), 404
             conn.commit()
+        invalidate_task_snapshot(cert_id=cid)
         return jsonify({'success': True})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -1564,5 +2894,6 @@ if __name__ == '__main__':
     init_db()
     start_scheduler()
     start_agent_status_refresh()
+    start_execution_retention()
     from config import HOST, PORT, DEBUG
     app.run(debug=DEBUG, host=HOST, port=PORT)
\ No newline at end of file
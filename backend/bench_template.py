@@ -0,0 +1,59 @@
+"""
+模板渲染基准：对比逐条渲染（每条重新解析全部参数）与按批渲染（批内不变参数只解析一次）的单条耗时
+用法：python bench_template.py [--repeat 3]
+"""
+import argparse
+import time
+from datetime import datetime
+
+from template_utils import compile_template, iter_rendered, render_compiled
+
+TEMPLATE = (
+    '{"id":{id},"user":"{user}","event":"click","time":"{now}","ts":{ts},"ts10":{ts10},'
+    '"batch":{batch},"source":"{source}","payload":{"page":"/home","ref":"{source}"}}'
+)
+PARAM_CONFIG = [
+    {'param': 'id', 'type': 'round_robin', 'value': ''},
+    {'param': 'user', 'type': 'round_robin', 'value': 'alice,bob,carol'},
+    {'param': 'now', 'type': 'current_time', 'value': '%Y-%m-%d %H:%M:%S'},
+    {'param': 'ts', 'type': 'timestamp_13', 'value': ''},
+    {'param': 'ts10', 'type': 'timestamp_10', 'value': ''},
+    {'param': 'batch', 'type': 'batch', 'value': ''},
+    {'param': 'source', 'type': 'fixed', 'value': 'bench'},
+]
+BATCH_SIZES = [1, 10, 100, 1000, 10000, 100000]
+
+
+def _per_message_us(fn, batch_size, repeat):
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn(batch_size)
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return best / batch_size * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=3, help='每组取最优的重复次数')
+    args = parser.parse_args()
+
+    compiled = compile_template(TEMPLATE, PARAM_CONFIG)
+    ref = datetime.now()
+
+    def per_message(n):
+        return [render_compiled(compiled, 7, message_index_in_batch=i, reference_time=ref) for i in range(n)]
+
+    def per_batch(n):
+        return list(iter_rendered(compiled, 7, 0, n, ref))
+
+    print('%-10s %16s %16s %8s' % ('batch', 'per-message(us)', 'per-batch(us)', 'speedup'))
+    for n in BATCH_SIZES:
+        a = _per_message_us(per_message, n, args.repeat)
+        b = _per_message_us(per_batch, n, args.repeat)
+        print('%-10d %16.3f %16.3f %7.2fx' % (n, a, b, a / b))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,6 @@
 """
 数据库模块
 """
-from .db import get_db, init_db, is_admin_ip
+from .db import get_db, init_db, is_admin_ip, invalidate_admin_ip_cache
 
-__all__ = ['get_db', 'init_db', 'is_admin_ip']
+__all__ = ['get_db', 'init_db', 'is_admin_ip', 'invalidate_admin_ip_cache']
@@ -13,12 +13,46 @@ from config import (
     ADMIN_USERNAME, ADMIN_PASSWORD,
 )
 from werkzeug.security import generate_password_hash, check_password_hash
+import ipaddress
+import threading
+import time
+from collections import deque
+
+try:
+    from config import DB_POOL_MIN_SIZE
+except ImportError:
+    DB_POOL_MIN_SIZE = 2  # 连接池常驻的最少连接数
+try:
+    from config import DB_POOL_MAX_SIZE
+except ImportError:
+    DB_POOL_MAX_SIZE = 20  # 连接池最多同时打开的连接数
+try:
+    from config import DB_POOL_MAX_LIFETIME
+except ImportError:
+    DB_POOL_MAX_LIFETIME = 3600  # 连接最长使用秒数，超过后归还时关闭重建
+try:
+    from config import DB_POOL_WAIT_TIMEOUT
+except ImportError:
+    DB_POOL_WAIT_TIMEOUT = 10  # 连接耗尽时最多等待秒数，超时抛 PoolTimeoutError
+try:
+    from config import DB_POOL_PING_IDLE_SECONDS
+except ImportError:
+    DB_POOL_PING_IDLE_SECONDS = 5  # 空闲超过该秒数的连接借出前先 ping，0 表示每次借出都 ping
+
+try:
+    from config import ADMIN_IP_REFRESH_SECONDS
+except ImportError:
+    ADMIN_IP_REFRESH_SECONDS = 10  # 管理员 IP 集合重新加载 admin_ips 表的间隔（秒）
 
 _pool = None
+_pool_lock = threading.Lock()
+# 管理员 IP 集合：exact 为无法解析为 IP/网段的原样条目，prefixes 为 (IP 版本, 前缀长度) -> {网络号}
+_admin_ips = {'exact': frozenset(), 'prefixes': {}, 'loaded_at': 0}
+_admin_ips_lock = threading.Lock()
 
 
 def get_connection():
-    """获取数据库连接"""
+    """获取一个独立的数据库连接（不经连接池，调用方负责关闭；用于长期占用的连接）"""
     return pymysql.connect(
         host=MYSQL_HOST,
         port=MYSQL_PORT,
@@ -30,18 +64,164 @@ def get_connection():
     )
 
 
+class PoolTimeoutError(Exception):
+    """连接池耗尽且等待超时"""
+
+
+class ConnectionPool:
+    """线程安全的 MySQL 连接池：借出前 ping 空闲较久的连接，超过最长使用时间的连接归还时关闭"""
+
+    def __init__(self, min_size=DB_POOL_MIN_SIZE, max_size=DB_POOL_MAX_SIZE, max_lifetime=DB_POOL_MAX_LIFETIME,
+                 wait_timeout=DB_POOL_WAIT_TIMEOUT, ping_idle_seconds=DB_POOL_PING_IDLE_SECONDS):
+        self.min_size = max(0, int(min_size))
+        self.max_size = max(1, int(max_size))
+        self.max_lifetime = max_lifetime
+        self.wait_timeout = wait_timeout
+        self.ping_idle_seconds = ping_idle_seconds
+        self._cond = threading.Condition(threading.Lock())
+        self._idle = deque()  # (conn, created_at, released_at)，右端为最近归还
+        self._created = {}  # id(conn) -> created_at，含借出中的连接
+        self._size = 0  # 已打开 + 正在建立的连接数
+        self._stats = {'checkouts': 0, 'waits': 0, 'wait_timeouts': 0, 'created': 0, 'closed': 0, 'ping_failures': 0}
+
+    def _open(self):
+        try:
+            conn = get_connection()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._created[id(conn)] = time.time()
+            self._stats['created'] += 1
+        return conn
+
+    def _discard(self, conn):
+        with self._cond:
+            if self._created.pop(id(conn), None) is not None:
+                self._size -= 1
+                self._stats['closed'] += 1
+            self._cond.notify()
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def fill(self):
+        """预先建立 min_size 个连接"""
+        while True:
+            with self._cond:
+                if self._size >= self.min_size:
+                    return
+                self._size += 1
+            conn = self._open()
+            with self._cond:
+                now = time.time()
+                self._idle.append((conn, now, now))
+                self._cond.notify()
+
+    def acquire(self):
+        deadline = None
+        with self._cond:
+            self._stats['checkouts'] += 1
+        while True:
+            with self._cond:
+                while True:
+                    if self._idle:
+                        conn, created_at, released_at = self._idle.pop()
+                        break
+                    if self._size < self.max_size:
+                        self._size += 1
+                        conn = None
+                        break
+                    if deadline is None:
+                        deadline = time.time() + self.wait_timeout
+                        self._stats['waits'] += 1
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self._stats['wait_timeouts'] += 1
+                        raise PoolTimeoutError(f'数据库连接池已耗尽（{self.max_size}），等待 {self.wait_timeout} 秒超时')
+                    self._cond.wait(remaining)
+            if conn is None:
+                return self._open()
+            now = time.time()
+            if self.max_lifetime and now - created_at >= self.max_lifetime:
+                self._discard(conn)
+                continue
+            if now - released_at >= self.ping_idle_seconds:
+                try:
+                    conn.ping(reconnect=False)
+                except Exception:
+                    with self._cond:
+                        self._stats['ping_failures'] += 1
+                    self._discard(conn)
+                    continue
+            return conn
+
+    def release(self, conn, broken=False):
+        """归还连接；broken 为 True（事务状态不明）或已超过最长使用时间时直接关闭"""
+        with self._cond:
+            created_at = self._created.get(id(conn))
+        if created_at is None:
+            try:
+                conn.close()
+            except Exception:
+                pass
+            return
+        now = time.time()
+        if broken or not conn.open or (self.max_lifetime and now - created_at >= self.max_lifetime):
+            self._discard(conn)
+            return
+        with self._cond:
+            self._idle.append((conn, created_at, now))
+            self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            idle = len(self._idle)
+            data = dict(self._stats)
+            data.update({
+                'size': self._size,
+                'idle': idle,
+                'in_use': self._size - idle,
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+            })
+        return data
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool()
+    return _pool
+
+
+def get_pool_stats():
+    """连接池统计：size/idle/in_use 与借出、等待、超时、新建、关闭次数"""
+    return get_pool().stats()
+
+
 @contextmanager
 def get_db():
-    """数据库连接上下文管理器"""
-    conn = get_connection()
+    """数据库连接上下文管理器（从连接池借出，正常结束提交、异常回滚后归还）"""
+    pool = get_pool()
+    conn = pool.acquire()
+    broken = False
     try:
         yield conn
         conn.commit()
     except Exception:
-        conn.rollback()
+        try:
+            conn.rollback()
+        except Exception:
+            broken = True
         raise
     finally:
-        conn.close()
+        pool.release(conn, broken=broken)
 
 
 def init_db():
@@ -65,6 +245,10 @@ def init_db():
         ensure_admin_user(conn)
     finally:
         conn.close()
+    try:
+        get_pool().fill()
+    except Exception:
+        pass
 
 
 def migrate_db(conn=None):
@@ -110,6 +294,26 @@ def migrate_db(conn=None):
                 cursor.execute(
                     "ALTER TABLE data_tasks ADD COLUMN stop_reason VARCHAR(255) NULL DEFAULT NULL COMMENT '自动停止原因，如连续失败超过3次' AFTER status"
                 )
+            cursor.execute(
+                "SELECT COUNT(*) AS n FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = %s AND TABLE_NAME = 'data_tasks' AND COLUMN_NAME = 'agent_ids'",
+                (MYSQL_DATABASE,)
+            )
+            if cursor.fetchone()['n'] == 0:
+                cursor.execute(
+                    "ALTER TABLE data_tasks ADD COLUMN agent_ids TEXT NULL DEFAULT NULL COMMENT 'Agent组[id...]（含主Agent），多个时并行分摊每批' AFTER agent_id"
+                )
+            cursor.execute(
+                "SELECT COUNT(*) AS n FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = %s AND TABLE_NAME = 'data_tasks' AND COLUMN_NAME = 'max_concurrent_runs'",
+                (MYSQL_DATABASE,)
+            )
+            if cursor.fetchone()['n'] == 0:
+                cursor.execute(
+                    "ALTER TABLE data_tasks ADD COLUMN max_concurrent_runs INT NOT NULL DEFAULT 1 COMMENT '同一任务最多同时执行数' AFTER connector_config"
+                )
+                cursor.execute(
+                    "ALTER TABLE data_tasks ADD COLUMN overlap_policy ENUM('skip', 'queue', 'parallel') NOT NULL DEFAULT 'skip' "
+                    "COMMENT '达到并发上限时：skip 跳过/queue 排队/parallel 仍并行' AFTER max_concurrent_runs"
+                )
             cursor.execute(
                 "SELECT COUNT(*) AS n FROM information_schema.TABLES WHERE TABLE_SCHEMA = %s AND TABLE_NAME = 'kafka_certs'",
                 (MYSQL_DATABASE,)
@@ -138,6 +342,95 @@ def migrate_db(conn=None):
                         FOREIGN KEY (task_id) REFERENCES data_tasks(id) ON DELETE CASCADE
                     ) ENGINE=InnoDB DEFAULT CHARSET=utf8
                 """)
+            cursor.execute(
+                "SELECT COUNT(*) AS n FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = %s AND TABLE_NAME = 'data_tasks' AND COLUMN_NAME = 'next_batch_no'",
+                (MYSQL_DATABASE,)
+            )
+            if cursor.fetchone()['n'] == 0:
+                cursor.execute(
+                    "ALTER TABLE data_tasks ADD COLUMN next_batch_no BIGINT NOT NULL DEFAULT 1 COMMENT '下次执行的批次号' AFTER overlap_policy"
+                )
+                cursor.execute(
+                    "ALTER TABLE data_tasks ADD COLUMN consecutive_failures INT NOT NULL DEFAULT 0 COMMENT '连续失败次数' AFTER next_batch_no"
+                )
+                cursor.execute(
+                    'UPDATE data_tasks t SET next_batch_no = '
+                    '(SELECT COALESCE(MAX(e.batch_no), 0) + 1 FROM task_executions e WHERE e.task_id = t.id)'
+                )
+            # 批次号/失败计数每次执行都会更新，不应改动 updated_at（调度器据此发现任务定义变更）；
+            # 替换 schema.sql 中的简单触发器（旧库执行 schema.sql 时尚无这两列，只能在补列后创建）
+            cursor.execute('DROP TRIGGER IF EXISTS data_tasks_before_update')
+            cursor.execute(
+                'CREATE TRIGGER data_tasks_before_update BEFORE UPDATE ON data_tasks FOR EACH ROW '
+                'SET NEW.updated_at = IF(NEW.status <> OLD.status OR (NEW.next_batch_no = OLD.next_batch_no '
+                'AND NEW.consecutive_failures = OLD.consecutive_failures), NOW(), OLD.updated_at)'
+            )
+            # 调度器每隔几秒取 MAX(updated_at) 检测任务变更，加索引避免全表扫描
+            cursor.execute(
+                "SELECT COUNT(*) AS n FROM information_schema.STATISTICS WHERE TABLE_SCHEMA = %s AND TABLE_NAME = 'data_tasks' AND INDEX_NAME = 'idx_updated_at'",
+                (MYSQL_DATABASE,)
+            )
+            if cursor.fetchone()['n'] == 0:
+                cursor.execute('ALTER TABLE data_tasks ADD INDEX idx_updated_at (updated_at)')
+            cursor.execute(
+                "SELECT COUNT(*) AS n FROM information_schema.STATISTICS WHERE TABLE_SCHEMA = %s AND TABLE_NAME = 'task_executions' AND INDEX_NAME = 'idx_task_id_id'",
+                (MYSQL_DATABASE,)
+            )
+            if cursor.fetchone()['n'] == 0:
+                cursor.execute('ALTER TABLE task_executions ADD INDEX idx_task_id_id (task_id, id)')
+            # (task_id, id) 已可支撑外键与按任务查询，去掉冗余的单列索引
+            cursor.execute(
+                "SELECT COUNT(*) AS n FROM information_schema.STATISTICS WHERE TABLE_SCHEMA = %s AND TABLE_NAME = 'task_executions' AND INDEX_NAME = 'idx_task_id'",
+                (MYSQL_DATABASE,)
+            )
+            if cursor.fetchone()['n'] > 0:
+                cursor.execute('ALTER TABLE task_executions DROP INDEX idx_task_id')
+            cursor.execute(
+                "SELECT COUNT(*) AS n FROM information_schema.TABLES WHERE TABLE_SCHEMA = %s AND TABLE_NAME = 'task_execution_rollups'",
+                (MYSQL_DATABASE,)
+            )
+            if cursor.fetchone()['n'] == 0:
+                cursor.execute("""
+                    CREATE TABLE task_execution_rollups (
+                        id BIGINT AUTO_INCREMENT PRIMARY KEY,
+                        task_id INT NOT NULL,
+                        granularity ENUM('hour', 'day') NOT NULL,
+                        period_start DATETIME NOT NULL COMMENT '小时或天的起始时间',
+                        executions INT NOT NULL DEFAULT 0,
+                        successes INT NOT NULL DEFAULT 0,
+                        records_count BIGINT NOT NULL DEFAULT 0,
+                        UNIQUE KEY uk_task_period (task_id, granularity, period_start),
+                        FOREIGN KEY (task_id) REFERENCES data_tasks(id) ON DELETE CASCADE
+                    ) ENGINE=InnoDB DEFAULT CHARSET=utf8
+                """)
+            cursor.execute(
+                "SELECT COUNT(*) AS n FROM information_schema.TABLES WHERE TABLE_SCHEMA = %s AND TABLE_NAME = 'scheduler_nodes'",
+                (MYSQL_DATABASE,)
+            )
+            if cursor.fetchone()['n'] == 0:
+                cursor.execute("""
+                    CREATE TABLE scheduler_nodes (
+                        node_id VARCHAR(128) NOT NULL PRIMARY KEY COMMENT '主机名:进程号',
+                        host VARCHAR(100) NULL,
+                        pid INT NULL,
+                        started_at DATETIME NULL,
+                        heartbeat_at DATETIME NOT NULL,
+                        INDEX idx_heartbeat_at (heartbeat_at)
+                    ) ENGINE=InnoDB DEFAULT CHARSET=utf8
+                """)
+            cursor.execute(
+                "SELECT COUNT(*) AS n FROM information_schema.TABLES WHERE TABLE_SCHEMA = %s AND TABLE_NAME = 'task_progress'",
+                (MYSQL_DATABASE,)
+            )
+            if cursor.fetchone()['n'] == 0:
+                cursor.execute("""
+                    CREATE TABLE task_progress (
+                        task_id INT NOT NULL PRIMARY KEY,
+                        progress TEXT NOT NULL COMMENT 'JSON：batch_no, total, chunks, items, status 等',
+                        updated_at DATETIME NOT NULL,
+                        FOREIGN KEY (task_id) REFERENCES data_tasks(id) ON DELETE CASCADE
+                    ) ENGINE=InnoDB DEFAULT CHARSET=utf8
+                """)
         conn.commit()
     finally:
         if close_conn:
@@ -166,23 +459,82 @@ def ensure_admin_user(conn=None):
             conn.close()
 
 
+def _build_admin_ip_index(entries):
+    """把 IP / CIDR 条目整理为按前缀长度分组的网络号集合，单个 IP 视为 /32 或 /128"""
+    exact = set()
+    prefixes = {}
+    for entry in entries:
+        entry = str(entry or '').strip()
+        if not entry:
+            continue
+        try:
+            net = ipaddress.ip_network(entry, strict=False)
+        except ValueError:
+            exact.add(entry)
+            continue
+        shift = net.max_prefixlen - net.prefixlen
+        prefixes.setdefault((net.version, net.prefixlen), set()).add(int(net.network_address) >> shift)
+    return {'exact': frozenset(exact), 'prefixes': prefixes}
+
+
+def _load_admin_ips(conn=None):
+    if conn is None:
+        with get_db() as conn:
+            return _load_admin_ips(conn)
+    with conn.cursor() as cursor:
+        cursor.execute('SELECT ip FROM admin_ips')
+        rows = cursor.fetchall()
+    entries = list(DEFAULT_ADMIN_IPS or []) + list(DEPLOYMENT_IPS or []) + [r['ip'] for r in rows]
+    index = _build_admin_ip_index(entries)
+    index['loaded_at'] = time.time()
+    return index
+
+
+def invalidate_admin_ip_cache():
+    """admin_ips 表修改后调用：下次判断时重新加载管理员 IP 集合"""
+    global _admin_ips
+    with _admin_ips_lock:
+        _admin_ips = dict(_admin_ips, loaded_at=0)
+
+
+def _get_admin_ips(conn=None):
+    global _admin_ips
+    index = _admin_ips
+    if time.time() - index['loaded_at'] < ADMIN_IP_REFRESH_SECONDS:
+        return index
+    # 同一时间只有一个线程重新加载，其余线程继续使用旧集合
+    if not _admin_ips_lock.acquire(blocking=index['loaded_at'] == 0):
+        return index
+    try:
+        index = _admin_ips
+        if time.time() - index['loaded_at'] >= ADMIN_IP_REFRESH_SECONDS:
+            try:
+                index = _load_admin_ips(conn)
+            except Exception:
+                # 读取失败时先用配置中的 IP，稍后重试
+                if not index['prefixes'] and not index['exact']:
+                    index = _build_admin_ip_index(list(DEFAULT_ADMIN_IPS or []) + list(DEPLOYMENT_IPS or []))
+                index = dict(index, loaded_at=time.time() - ADMIN_IP_REFRESH_SECONDS + 1)
+            _admin_ips = index
+        return index
+    finally:
+        _admin_ips_lock.release()
+
+
 def is_admin_ip(ip, conn=None):
-    """检查IP是否为管理员（部署机器所在 IP 或数据库 admin_ips 表中的 IP 均可管理所有 Agent/任务）"""
+    """检查IP是否为管理员（部署机器所在 IP 或数据库 admin_ips 表中的 IP/网段均可管理所有 Agent/任务）"""
     if not ip:
         return False
     ip = str(ip).strip()
-    if ip in DEFAULT_ADMIN_IPS or ip in DEPLOYMENT_IPS:
+    index = _get_admin_ips(conn)
+    if ip in index['exact']:
         return True
     try:
-        close_conn = conn is None
-        if conn is None:
-            conn = get_connection()
-        try:
-            with conn.cursor() as cursor:
-                cursor.execute('SELECT 1 FROM admin_ips WHERE ip = %s', (ip,))
-                return cursor.fetchone() is not None
-        finally:
-            if close_conn:
-                conn.close()
-    except Exception:
+        addr = ipaddress.ip_address(ip)
+    except ValueError:
         return False
+    value = int(addr)
+    for (version, prefixlen), networks in index['prefixes'].items():
+        if version == addr.version and value >> (addr.max_prefixlen - prefixlen) in networks:
+            return True
+    return False
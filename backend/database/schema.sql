@@ -48,9 +48,14 @@ CREATE TABLE IF NOT EXISTS data_tasks (
     cron_expr VARCHAR(100) NOT NULL COMMENT 'Cron表达式',
     batch_size INT DEFAULT 1 COMMENT '每批数据条数',
     agent_id INT NOT NULL COMMENT '执行Agent',
+    agent_ids TEXT DEFAULT NULL COMMENT 'Agent组[id...]（含主Agent），多个时并行分摊每批',
     template_content TEXT NOT NULL COMMENT '模板内容(JSON或SQL)',
     param_config TEXT DEFAULT NULL COMMENT '参数配置[{param, type, value}]',
     connector_config TEXT DEFAULT NULL COMMENT '连接器配置(Kafka/ClickHouse)',
+    max_concurrent_runs INT NOT NULL DEFAULT 1 COMMENT '同一任务最多同时执行数',
+    overlap_policy ENUM('skip', 'queue', 'parallel') NOT NULL DEFAULT 'skip' COMMENT '达到并发上限时：skip 跳过/queue 排队/parallel 仍并行',
+    next_batch_no BIGINT NOT NULL DEFAULT 1 COMMENT '下次执行的批次号',
+    consecutive_failures INT NOT NULL DEFAULT 0 COMMENT '连续失败次数',
     creator_user_id INT NULL COMMENT '创建者用户ID',
     creator_ip VARCHAR(45) NULL COMMENT '创建者IP（审计）',
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
@@ -58,6 +63,7 @@ CREATE TABLE IF NOT EXISTS data_tasks (
     INDEX idx_creator_user_id (creator_user_id),
     INDEX idx_creator_ip (creator_ip),
     INDEX idx_status (status),
+    INDEX idx_updated_at (updated_at),
     FOREIGN KEY (agent_id) REFERENCES agents(id) ON DELETE RESTRICT,
     FOREIGN KEY (creator_user_id) REFERENCES users(id) ON DELETE SET NULL
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
@@ -95,6 +101,16 @@ CREATE TABLE IF NOT EXISTS data_task_schedule_claims (
     FOREIGN KEY (task_id) REFERENCES data_tasks(id) ON DELETE CASCADE
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
 
+-- 调度节点表（sharded 调度模式下各后端进程心跳注册，按任务 id 一致性哈希分片）
+CREATE TABLE IF NOT EXISTS scheduler_nodes (
+    node_id VARCHAR(128) NOT NULL PRIMARY KEY COMMENT '主机名:进程号',
+    host VARCHAR(100) NULL,
+    pid INT NULL,
+    started_at DATETIME NULL,
+    heartbeat_at DATETIME NOT NULL,
+    INDEX idx_heartbeat_at (heartbeat_at)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+
 -- 任务执行记录表
 CREATE TABLE IF NOT EXISTS task_executions (
     id BIGINT AUTO_INCREMENT PRIMARY KEY,
@@ -104,7 +120,28 @@ CREATE TABLE IF NOT EXISTS task_executions (
     success TINYINT(1) DEFAULT 1,
     result_message TEXT,
     records_count INT DEFAULT 0,
-    INDEX idx_task_id (task_id),
+    INDEX idx_task_id_id (task_id, id),
     INDEX idx_executed_at (executed_at),
     FOREIGN KEY (task_id) REFERENCES data_tasks(id) ON DELETE CASCADE
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+
+-- 执行记录汇总（明细超过保留期后按小时、再按天压缩）
+CREATE TABLE IF NOT EXISTS task_execution_rollups (
+    id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    task_id INT NOT NULL,
+    granularity ENUM('hour', 'day') NOT NULL,
+    period_start DATETIME NOT NULL COMMENT '小时或天的起始时间',
+    executions INT NOT NULL DEFAULT 0,
+    successes INT NOT NULL DEFAULT 0,
+    records_count BIGINT NOT NULL DEFAULT 0,
+    UNIQUE KEY uk_task_period (task_id, granularity, period_start),
+    FOREIGN KEY (task_id) REFERENCES data_tasks(id) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+
+-- 任务分块下发进度（多 worker 共享，每块完成后更新）
+CREATE TABLE IF NOT EXISTS task_progress (
+    task_id INT NOT NULL PRIMARY KEY,
+    progress TEXT NOT NULL COMMENT 'JSON：batch_no, total, chunks, items, status 等',
+    updated_at DATETIME NOT NULL,
+    FOREIGN KEY (task_id) REFERENCES data_tasks(id) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
@@ -1,11 +1,24 @@
 """
 模板+参数渲染
 支持 {param} 语法，参数类型：fixed, current_time, timestamp_13, timestamp_10, round_robin, batch
+模板按 (模板, 参数配置) 编译为「字面量片段 + 参数槽位」并做 LRU 缓存，每条消息渲染只需一次 join
 """
 import re
 import json
 import time
+from collections import namedtuple
 from datetime import datetime
+from functools import lru_cache
+
+try:
+    from config import TEMPLATE_CACHE_SIZE
+except ImportError:
+    TEMPLATE_CACHE_SIZE = 256
+
+# 编译后的模板：parts 为字面量片段与槽位交错的元组（槽位处为 None，渲染时填值）；slots 为 ((parts 下标, 参数规格), ...)
+CompiledTemplate = namedtuple('CompiledTemplate', ['parts', 'slots'])
+
+DEFAULT_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
 
 
 def extract_params(template_str):
@@ -13,6 +26,86 @@ def extract_params(template_str):
     return list(set(re.findall(r'\{(\w+)\}', template_str)))
 
 
+def _normalize_param(cfg):
+    """将一条参数配置预处理为渲染时直接使用的规格（轮询值拆分、时间格式默认值等只做一次）"""
+    ptype = cfg.get('type', 'fixed')
+    value = cfg.get('value', '') or ''
+    spec = {'param': str(cfg.get('param')), 'type': ptype, 'value': value}
+    if ptype == 'current_time':
+        spec['format'] = (value or '').strip() or DEFAULT_TIME_FORMAT
+    elif ptype == 'round_robin':
+        vals = None
+        if isinstance(value, str) and value.strip():
+            vals = [v.strip() for v in value.split(',') if v.strip()]
+        spec['values'] = vals
+    return spec
+
+
+@lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def _compile_cached(template_str, param_key):
+    specs = {}
+    for cfg in json.loads(param_key):
+        param = cfg.get('param')
+        # 同名参数以第一条为准（与逐个 str.replace 的旧行为一致）
+        if not param or str(param) in specs:
+            continue
+        specs[str(param)] = _normalize_param(cfg)
+    if not specs:
+        return CompiledTemplate((template_str,), ())
+    pattern = re.compile('|'.join(re.escape('{%s}' % p) for p in sorted(specs, key=len, reverse=True)))
+    parts = []
+    slots = []
+    pos = 0
+    for m in pattern.finditer(template_str):
+        parts.append(template_str[pos:m.start()])
+        slots.append((len(parts), specs[m.group()[1:-1]]))
+        parts.append(None)
+        pos = m.end()
+    parts.append(template_str[pos:])
+    return CompiledTemplate(tuple(parts), tuple(slots))
+
+
+def compile_template(template_str, param_config):
+    """编译模板为字面量片段 + 参数槽位，按 (template, param_config) LRU 缓存"""
+    param_key = json.dumps(param_config or [], sort_keys=True, ensure_ascii=False, default=str)
+    return _compile_cached(template_str, param_key)
+
+
+def _resolve_param(spec, batch_no, message_index_in_batch, base_dt, base_ts, round_robin_values):
+    """计算单个参数槽位的渲染值"""
+    ptype = spec['type']
+    if ptype == 'fixed':
+        return str(spec['value'])
+    if ptype == 'current_time':
+        return base_dt.strftime(spec['format'])
+    if ptype == 'timestamp_13':
+        return str(int(base_ts * 1000))
+    if ptype == 'timestamp_10':
+        return str(int(base_ts))
+    if ptype == 'round_robin':
+        vals = round_robin_values.get(spec['param']) if round_robin_values else None
+        if vals is None:
+            vals = spec['values']
+        if vals:
+            return str(vals[(batch_no - 1 + message_index_in_batch) % len(vals)])
+        return str(message_index_in_batch + 1)
+    if ptype == 'batch':
+        return str(batch_no)
+    return str(spec['value'])
+
+
+def render_compiled(compiled, batch_no=1, round_robin_values=None, message_index_in_batch=0, reference_time=None):
+    """用已编译模板渲染一条：按槽位填值后一次 join"""
+    if not compiled.slots:
+        return compiled.parts[0]
+    base_dt = reference_time if reference_time is not None else datetime.now()
+    base_ts = base_dt.timestamp()
+    buf = list(compiled.parts)
+    for idx, spec in compiled.slots:
+        buf[idx] = _resolve_param(spec, batch_no, message_index_in_batch, base_dt, base_ts, round_robin_values)
+    return ''.join(buf)
+
+
 def render_template(template_str, param_config, batch_no=1, round_robin_values=None, message_index_in_batch=0, reference_time=None):
     """
     渲染模板
@@ -21,65 +114,118 @@ def render_template(template_str, param_config, batch_no=1, round_robin_values=N
     message_index_in_batch: 当前条在本批内的序号 0..batch_size-1，用于 round_robin 无值时渲染为 1..batch_size
     reference_time: 可选，用于 current_time/timestamp 的基准时间（cron 计划执行时间），未传则用当前时间
     """
-    result = template_str
-    round_robin_values = round_robin_values or {}
+    return render_compiled(
+        compile_template(template_str, param_config), batch_no,
+        round_robin_values=round_robin_values, message_index_in_batch=message_index_in_batch,
+        reference_time=reference_time)
+
+
+def _bind_batch(compiled, batch_no, reference_time=None):
+    """
+    预先解析本批内不变的槽位（fixed/current_time/timestamp_13/timestamp_10/batch 等，整批只算一次），
+    返回 (已填好不变槽位的 parts 列表, 逐条变化的 round_robin 槽位列表)
+    """
     base_dt = reference_time if reference_time is not None else datetime.now()
     base_ts = base_dt.timestamp()
-
-    for cfg in param_config or []:
-        param = cfg.get('param')
-        if not param:
-            continue
-        ptype = cfg.get('type', 'fixed')
-        value = cfg.get('value', '') or ''
-
-        if ptype == 'fixed':
-            repl = str(value)
-        elif ptype == 'current_time':
-            fmt = (value or '').strip() or '%Y-%m-%d %H:%M:%S'
-            repl = base_dt.strftime(fmt)
-        elif ptype == 'timestamp_13':
-            repl = str(int(base_ts * 1000))
-        elif ptype == 'timestamp_10':
-            repl = str(int(base_ts))
-        elif ptype == 'round_robin':
-            vals = round_robin_values.get(param)
-            if vals is None and isinstance(value, str) and value.strip():
-                vals = [v.strip() for v in value.split(',') if v.strip()]
-            if vals:
-                idx = (batch_no - 1 + message_index_in_batch) % len(vals)
-                repl = str(vals[idx] if isinstance(vals[idx], str) else vals[idx])
-            else:
-                repl = str(message_index_in_batch + 1)
-        elif ptype == 'batch':
-            repl = str(batch_no)
+    buf = list(compiled.parts)
+    varying = []
+    for idx, spec in compiled.slots:
+        if spec['type'] == 'round_robin':
+            varying.append((idx, spec))
         else:
-            repl = str(value)
+            buf[idx] = _resolve_param(spec, batch_no, 0, base_dt, base_ts, None)
+    return buf, varying
+
+
+def iter_rendered(compiled, batch_no, start, stop, reference_time=None):
+    """按本批内序号 [start, stop) 逐条渲染（生成器）；批内不变参数只解析一次，每条只填 round_robin 槽位"""
+    buf, varying = _bind_batch(compiled, batch_no, reference_time)
+    if not varying:
+        rendered = ''.join(buf)
+        for _ in range(start, stop):
+            yield rendered
+        return
+    for i in range(start, stop):
+        for idx, spec in varying:
+            vals = spec['values']
+            buf[idx] = str(vals[(batch_no - 1 + i) % len(vals)]) if vals else str(i + 1)
+        yield ''.join(buf)
+
+
+def _parse_kafka_message(rendered):
+    try:
+        data = json.loads(rendered)
+        return data if isinstance(data, dict) else {'data': data}
+    except json.JSONDecodeError:
+        return {'raw': rendered}
+
 
-        result = result.replace(f'{{{param}}}', repl)
+def iter_kafka_messages(template_json, param_config, batch_no, start, stop, reference_time=None):
+    """惰性渲染本批序号 [start, stop) 的 Kafka 消息并解析为 dict（生成器）"""
+    last_rendered = None
+    last_data = None
+    for rendered in iter_rendered(compile_template(template_json, param_config), batch_no, start, stop, reference_time):
+        if rendered is not last_rendered:
+            last_rendered, last_data = rendered, _parse_kafka_message(rendered)
+        yield last_data
 
-    return result
+
+def kafka_template_is_object(template_json, param_config, batch_no, reference_time=None):
+    """校验模板形状（只渲染一条）：能解析为 JSON 对象时才可走预序列化下发"""
+    rendered = next(iter_rendered(compile_template(template_json, param_config), batch_no, 0, 1, reference_time))
+    try:
+        return isinstance(json.loads(rendered), dict)
+    except json.JSONDecodeError:
+        return False
+
+
+def iter_kafka_payloads(template_json, param_config, batch_no, start, stop, reference_time=None):
+    """惰性渲染本批序号 [start, stop) 的 Kafka 消息 JSON 文本（预序列化，生成器），调用前应先用 kafka_template_is_object 校验"""
+    return iter_rendered(compile_template(template_json, param_config), batch_no, start, stop, reference_time)
+
+
+def iter_clickhouse_sqls(template_sqls, param_config, batch_no, start, stop, reference_time=None):
+    """惰性渲染本批序号 [start, stop) 的 ClickHouse SQL（生成器），每个序号依次产出模板列表中的每条 SQL"""
+    sqls = template_sqls if isinstance(template_sqls, list) else [str(template_sqls)]
+    iters = [iter_rendered(compile_template(sql, param_config), batch_no, start, stop, reference_time) for sql in sqls]
+    for _ in range(start, stop):
+        for it in iters:
+            yield next(it)
+
+
+def parse_columnar_template(template_content):
+    """
+    解析 ClickHouse 列式写入模板（描述一行）：{"table": "库.表", "columns": {"列名": "值模板", ...}}
+    返回 (table, [(列名, 值模板), ...])，列顺序与模板一致
+    """
+    obj = json.loads(template_content) if isinstance(template_content, str) else template_content
+    if not isinstance(obj, dict) or not obj.get('table') or not isinstance(obj.get('columns'), dict) or not obj['columns']:
+        raise ValueError('列式写入模板须为 {"table": "库.表", "columns": {"列名": "值模板", ...}}')
+    columns = [(str(k), v if isinstance(v, str) else json.dumps(v, ensure_ascii=False)) for k, v in obj['columns'].items()]
+    return str(obj['table']), columns
+
+
+def iter_clickhouse_rows(columns, param_config, batch_no, start, stop, reference_time=None):
+    """惰性渲染列式写入的行 [start, stop)（生成器，每行为各列文本值的元组）；每列单独编译，批内不变的列整批只渲染一次"""
+    iters = [iter_rendered(compile_template(tmpl, param_config), batch_no, start, stop, reference_time) for _, tmpl in columns]
+    return zip(*iters)
 
 
 def render_kafka_messages(template_json, param_config, batch_size, batch_no, reference_time=None):
     """渲染Kafka消息（JSON模板），每批生成batch_size条；round_robin 无值时为本批内序号 1..batch_size；reference_time 为 cron 计划时间"""
-    messages = []
-    for i in range(batch_size):
-        rendered = render_template(template_json, param_config, batch_no, message_index_in_batch=i, reference_time=reference_time)
-        try:
-            data = json.loads(rendered)
-            messages.append(data if isinstance(data, dict) else {'data': data})
-        except json.JSONDecodeError:
-            messages.append({'raw': rendered})
-    return messages
+    return list(iter_kafka_messages(template_json, param_config, batch_no, 0, batch_size, reference_time))
+
+
+def render_kafka_payloads(template_json, param_config, batch_size, batch_no, reference_time=None):
+    """
+    渲染Kafka消息为 JSON 文本（预序列化），由 Agent 直接编码为 bytes 发送，省去 json.loads/json.dumps 往返。
+    模板形状只校验一次：本批第一条须能解析为 JSON 对象，否则返回 None，由调用方回退到 render_kafka_messages
+    """
+    if batch_size > 0 and not kafka_template_is_object(template_json, param_config, batch_no, reference_time):
+        return None
+    return list(iter_kafka_payloads(template_json, param_config, batch_no, 0, batch_size, reference_time))
 
 
 def render_clickhouse_sqls(template_sqls, param_config, batch_size, batch_no, reference_time=None):
     """渲染ClickHouse SQL（模板列表），每批生成batch_size组SQL；round_robin 无值时为本批内序号 1..batch_size；reference_time 为 cron 计划时间"""
-    sqls = template_sqls if isinstance(template_sqls, list) else [str(template_sqls)]
-    result = []
-    for i in range(batch_size):
-        for sql in sqls:
-            rendered = render_template(sql, param_config, batch_no, message_index_in_batch=i, reference_time=reference_time)
-            result.append(rendered)
-    return result
+    return list(iter_clickhouse_sqls(template_sqls, param_config, batch_no, 0, batch_size, reference_time))